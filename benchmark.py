@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for hot paths in the game and tools
+
+usage: benchmark.py [-n NUMBER] [BENCHMARK ...]
+
+Each benchmark prints the time per call of the current code and,
+where there is one, of the older approach it replaced.
+
+"""
+from __future__ import with_statement, division, print_function, unicode_literals
+import sys
+import timeit
+from mtplane import MetatilePlane
+
+def best_time(fn, number):
+    """Return the fastest time of one call to fn, in microseconds."""
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+def report(name, new_us, old_us=None):
+    if old_us is None:
+        print("%-32s %9.2f us" % (name, new_us))
+    else:
+        print("%-32s %9.2f us (was %.2f us, %.1fx)"
+              % (name, new_us, old_us, old_us / new_us))
+
+class ListDirty(object):
+    """Dirty tracking as a list of rows of 32 bools, as MetatilePlane
+used to store it, for comparison.
+
+"""
+    def __init__(self, height=12, tw=16, th=16):
+        self.height, self.tw, self.th = height, tw, th
+        self.cleardirty(True)
+
+    def cleardirty(self, val):
+        self.dirty = [[bool(val)] * 32 for i in range(self.height)]
+
+    def setdirtyrect(self, x, y, w, h):
+        w += x % self.tw
+        w = -(-w // self.tw)
+        x = (x // self.tw) % 32
+        if w >= 32:
+            x, w = 0, 32
+        h += y % self.th
+        h = -(-h // self.th)
+        y = y // self.th
+        if y < 0:
+            h -= y
+            y = 0
+        if h > len(self.dirty) - y:
+            h = len(self.dirty) - y
+        leftw = max(0, x + w - 32)
+        w -= leftw
+        for row in self.dirty[y:y + h]:
+            if leftw:
+                row[:leftw] = [True] * leftw
+            row[x:x + w] = [True] * w
+
+    def getdirtyruns(self):
+        return [list(MetatilePlane.boolstoruns(row)) for row in self.dirty]
+
+    @staticmethod
+    def unionoldnewdirty(old, new):
+        ur = MetatilePlane.unionruns
+        return [list(ur(a, b)) for (a, b) in zip(old, new)]
+
+    setdirtyrects = MetatilePlane.setdirtyrects
+    dirtyrunstorects = MetatilePlane.dirtyrunstorects
+
+def bench_dirty(number):
+    """Dirty tracking for one frame with a few sprites on screen."""
+    # Player, rope and two tumbling blocks, last frame and this frame
+    old_rects = [(100, 90, 24, 32), (110, 40, 8, 56),
+                 (200, 150, 16, 16), (250, 100, 16, 16)]
+    new_rects = [(x + 2, y + 1, w, h) for (x, y, w, h) in old_rects]
+    camx = 37
+
+    def frame(pf):
+        pf.setdirtyrects(old_rects, camx)
+        old_dirty = pf.getdirtyruns()
+        pf.cleardirty(False)
+        pf.setdirtyrects(new_rects, camx)
+        all_dirty = pf.unionoldnewdirty(old_dirty, pf.getdirtyruns())
+        return pf.dirtyrunstorects(all_dirty)
+
+    pf = MetatilePlane()
+    old = ListDirty()
+    if frame(pf) != frame(old):
+        raise AssertionError("bitset and list dirty tracking disagree")
+    report("dirty tracking per frame",
+           best_time(lambda: frame(pf), number),
+           best_time(lambda: frame(old), number))
+
+    def scrolled(pf):
+        pf.cleardirty(True)
+        return pf.getdirtyruns()
+    report("dirty runs after scrolling",
+           best_time(lambda: scrolled(pf), number),
+           best_time(lambda: scrolled(old), number))
+
+def encode_level_bytewise(level):
+    """encode_level() as it was before it used array.byteswap()."""
+    import json
+
+    level = dict(level)
+    screens = level['screens']
+    level['screens'] = [len(s) for s in screens]
+    level = json.dumps(level, separators=(',', ':')).encode('utf-8')
+    screenwords = (b
+                   for s in screens
+                   for w in s
+                   for b in ((w >> 8) & 0xFF, w & 0xFF))
+    return b"%d\n%s%s" % (len(level), level, bytes(screenwords))
+
+def decode_level_bytewise(level):
+    """decode_level() as it was before it used array.frombytes()."""
+    import json
+    from array import array
+
+    jsonlen, rest = level.split(b'\n', 1)
+    jsonlen = int(jsonlen.decode('ascii'))
+    level = json.loads(rest[:jsonlen].decode('utf-8'))
+    lbytes = bytearray(rest[jsonlen:])
+    lwds = (((lbytes[i] << 8) | lbytes[i + 1]
+             for i in range(0, len(lbytes), 2)))
+    level['screens'] = [array('H', (next(lwds) for i in range(scrlen)))
+                        for scrlen in level['screens']]
+    level['start'] = tuple(level['start'])
+    return level
+
+def random_level(rng, num_screens):
+    """Make a level of random screen words in the .map format's ranges."""
+    from array import array
+
+    screens = []
+    for i in range(num_screens):
+        words = array('H')
+        for j in range(rng.randrange(40)):
+            if words and rng.random() < .3:
+                words.append(0xC000 | rng.randrange(16))
+            else:
+                words.append(rng.randrange(0xC000))
+        screens.append(words)
+    return {'screens': screens, 'start': (rng.randrange(16), rng.randrange(12))}
+
+def bench_codec(number):
+    """encode_level() and decode_level() on levels of 1 to 1000 screens."""
+    import random
+    from levels import encode_level, decode_level
+
+    rng = random.Random(1)
+    for i in range(500):
+        level = random_level(rng, rng.randrange(8))
+        data = encode_level(level)
+        if data != encode_level_bytewise(level):
+            raise AssertionError("encode_level differs on fuzz case %d" % i)
+        if (decode_level(data) != decode_level_bytewise(data)
+            or encode_level(decode_level(data)) != data):
+            raise AssertionError("decode_level differs on fuzz case %d" % i)
+
+    for num_screens in (1, 10, 100, 1000):
+        level = random_level(rng, num_screens)
+        data = encode_level(level)
+        n = max(1, number // num_screens)
+        report("encode_level %4d screens" % num_screens,
+               best_time(lambda: encode_level(level), n),
+               best_time(lambda: encode_level_bytewise(level), n))
+        report("decode_level %4d screens" % num_screens,
+               best_time(lambda: decode_level(data), n),
+               best_time(lambda: decode_level_bytewise(data), n))
+
+def markov_optimize_screen_greedy(cols):
+    """leveleditor.markov_optimize_screen() as it was before it found
+needed tiles with bytes operations and let strips cross runs.
+
+"""
+    from leveleditor import markov_fill_and_unfill
+
+    cols = [markov_fill_and_unfill(col) for col in cols]
+    filled = [col[0] for col in cols]
+    unfilled = [(x, y, c)
+                for (x, col) in enumerate(cols)
+                for (y, c) in enumerate(col[1])
+                if c]
+
+    # Right now, an object file can be created from unfilled.
+    # But first let's bucket sort them by Y so that we can find runs
+    # of a given row that cover at least 3 unfilled.  The objects
+    # are already sorted by X; sorting them by Y preserves this.
+    byrow = [[] for i in range(12)]
+    for (x, y, c) in unfilled:
+        byrow[y].append((x, c))
+    objs = []
+    for (y, row) in enumerate(byrow):
+        i = 0
+        while i < len(row):
+            x, c = row[i]
+
+            # if there aren't 2 more like objects after this
+            # on this row, emit a single tile
+            if (i + 3 > len(row)
+                or row[i + 1][1] != c
+                or row[i + 2][1] != c):
+                objs.append((x, y, c))
+                i += 1
+                continue
+
+            # So we know the next two objects on this row are the
+            # same tile number.  Search for how many are contiguous
+            # in the filled data.
+            xr = x + 1
+            while xr < len(filled) and filled[xr][y] == c:
+                xr += 1
+
+            # If the run is not long enough, emit a single tile
+            if row[i + 2][0] >= xr:
+                objs.append((x, y, c))
+                i += 1
+                continue
+
+            # Extend run to left for editor's convenience
+            while x > 0 and filled[x - 1][y] == c:
+                x -= 1
+
+            # Now subsume all objs within this run
+            oldi = i + 3
+            while i < len(row) and row[i][0] < xr:
+                i += 1
+            objs.append((x, y, c))
+            # Y=12 and X=0 means a run of tileno (2-15) more tiles
+            objs.append((0, 12, xr - x - 1))
+
+    # And at this point, we're ready to encode it
+    import array
+    screendata = array.array('H', (
+        (y << 12) | (x << 8) | c for (x, y, c) in objs
+    ))
+    return screendata
+
+def bench_screens(number):
+    """Editor's screen encoder on every shipped level."""
+    import glob
+    from levels import decode_level, markov_fill
+    from leveleditor import decode_entire_level, markov_optimize_screen
+
+    def filled(cols):
+        return [bytes(markov_fill(col)) for col in cols]
+
+    total_saved = 0
+    for filename in sorted(glob.glob('levels/*.map')):
+        with open(filename, 'rb') as infp:
+            level = decode_level(infp.read())
+        cols = decode_entire_level(level)
+        screens = [cols[i:i + 16] for i in range(0, len(cols), 16)]
+        encoded = [markov_optimize_screen(s) for s in screens]
+        decoded = decode_entire_level({'screens': encoded})
+        if filled(decoded[:len(cols)]) != filled(cols):
+            raise AssertionError("%s: re-encoded level decodes differently"
+                                 % filename)
+        greedy_words = sum(len(markov_optimize_screen_greedy(s))
+                           for s in screens)
+        n = max(1, number // (10 * len(screens)))
+        report("encode %s" % filename,
+               best_time(lambda: [markov_optimize_screen(s) for s in screens], n),
+               best_time(lambda: [markov_optimize_screen_greedy(s)
+                                  for s in screens], n))
+        old_words = sum(len(s) for s in level['screens'])
+        new_words = sum(len(s) for s in encoded)
+        total_saved += 2 * (old_words - new_words)
+        print("%-32s %5d words in file, %5d re-encoded (was %d), "
+              "%d bytes saved"
+              % ("", old_words, new_words, greedy_words,
+                 2 * (old_words - new_words)))
+    print("%d bytes saved in all levels" % total_saved)
+
+def synth_square_effect_per_sample(snddata, samples_per_frame):
+    """chipsfx.synth_square_effect() as it was before it added runs of
+constant samples at once.
+
+"""
+    from array import array
+    from chipsfx import notePeriods
+
+    phase = 0
+    periodcd = 0
+    out = array('h')
+    snddata = iter(snddata)
+    while True:
+        try:
+            dutyvol = next(snddata)
+            period = notePeriods[next(snddata)]
+        except StopIteration:
+            break
+        duty = [1,2,4,6][(dutyvol >> 6) & 0x03]
+        vol = 1000 * (dutyvol & 0x0F)
+        for s in range(samples_per_frame):
+            level = vol if phase < duty else 0
+            if periodcd < 1:
+                # simulated box filtering
+                phase = (phase + 1) % 8
+                level2 = vol if phase < duty else 0
+                level = level2 + int(max(0, periodcd) * (level - level2))
+                periodcd += period
+            periodcd -= 1
+            out.append(level)
+    return out
+
+def synth_triangle_effect_per_sample(snddata, samples_per_frame):
+    """chipsfx.synth_triangle_effect() as it was before it added runs of
+constant samples at once.
+
+"""
+    from array import array
+    from chipsfx import notePeriods
+
+    phase = 0
+    periodcd = 0
+    out = array('h')
+    snddata = iter(snddata)
+    # triangle is balanced polarity
+    samples = [1000*x for x in range(1, 17, 2)]
+    samples.extend(reversed(samples))
+    samples.extend([-i for i in samples])
+    while True:
+        try:
+            dutyvol = next(snddata)
+            period = notePeriods[next(snddata)] / 2
+        except StopIteration:
+            break
+        for s in range(samples_per_frame):
+            level = samples[phase]
+            if periodcd < 1:
+                # simulated box filtering
+                phase = (phase + 1) % 32
+                level2 = samples[phase]
+                level = level2 + int(max(0, periodcd) * (level - level2))
+                periodcd += period
+            periodcd -= 1
+            out.append(level)
+
+    # anti-pop
+    level = samples[phase]
+    out.extend(i * level // samples_per_frame
+               for i in range(samples_per_frame, 0, -1))
+    return out
+
+def synth_noise_effect_per_sample(snddata, samples_per_frame):
+    """chipsfx.synth_noise_effect() as it was before it added runs of
+constant samples at once.
+
+"""
+    from array import array
+    from chipsfx import noisePeriods
+
+    shiftreg = 0x4321
+    periodcd = 0
+    out = array('h')
+    snddata = iter(snddata)
+    lastlevel = 0
+    while True:
+        try:
+            # because square sfx are positive polarity, make noise
+            # sfx negative
+            vol = -1000 * (next(snddata) & 0x0F)
+            dutyperiod = next(snddata)
+        except StopIteration:
+            break
+        period = noisePeriods[dutyperiod & 0x0F]
+        othertap = 6 if dutyperiod & 0x80 else 1
+        for s in range(samples_per_frame):
+            if periodcd < 1:
+                newbit = ((shiftreg >> othertap) ^ shiftreg) & 0x01
+                shiftreg = (shiftreg >> 1) | (newbit << 14)
+                level2 = vol if newbit else 0
+                level = level2 + int(max(0, periodcd) * (lastlevel - level2))
+                lastlevel = level2
+                periodcd += period
+            else:
+                level = lastlevel
+            periodcd -= 1
+            out.append(level)
+    return out
+
+def bench_sfx(number):
+    """Sound effect synthesis, on random effects and the game's own."""
+    import random
+    import chipsfx
+    from wbb import sfxdata
+
+    synths = [
+        ('square', chipsfx.synth_square_effect, synth_square_effect_per_sample),
+        ('triangle', chipsfx.synth_triangle_effect,
+         synth_triangle_effect_per_sample),
+        ('noise', chipsfx.synth_noise_effect, synth_noise_effect_per_sample),
+    ]
+    rng = random.Random(1)
+    for (name, new, old) in synths:
+        for i in range(500):
+            snddata = [rng.randrange(256) if j % 2 == 0 or name == 'noise'
+                       else rng.randrange(len(chipsfx.notePeriods))
+                       for j in range(rng.randrange(24))]
+            samples_per_frame = rng.choice((1, 7, 735, 1470))
+            if (new(snddata, samples_per_frame)
+                != old(snddata, samples_per_frame)):
+                raise AssertionError("%s synth differs on fuzz case %d"
+                                     % (name, i))
+
+    baselen = chipsfx.mixer_freq // 60
+    for (name, ch, framelen, data) in sfxdata:
+        new, old = [synths[2 if ch >= 12 else 1 if ch >= 8 else 0][i]
+                    for i in (1, 2)]
+        n = max(1, number // 200)
+        report("synth %s" % name,
+               best_time(lambda: new(data, framelen * baselen), n),
+               best_time(lambda: old(data, framelen * baselen), n))
+
+benchmarks = [
+    ('dirty', bench_dirty),
+    ('codec', bench_codec),
+    ('screens', bench_screens),
+    ('sfx', bench_sfx),
+]
+
+def main(argv=None):
+    import argparse
+
+    names = [name for (name, fn) in benchmarks]
+    parser = argparse.ArgumentParser(
+        description="Time hot paths in the game and tools."
+    )
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK",
+                        help="benchmarks to run (default: all of %s)"
+                             % ", ".join(names))
+    parser.add_argument("-n", "--number", type=int, default=2000,
+                        help="calls to time in each of 5 repeats")
+    args = parser.parse_args((argv or sys.argv)[1:])
+    for name in args.benchmarks:
+        if name not in names:
+            parser.error("unknown benchmark %s" % name)
+    for (name, fn) in benchmarks:
+        if not args.benchmarks or name in args.benchmarks:
+            fn(args.number)
+
+if __name__=='__main__':
+    main()
@@ -32,10 +32,29 @@ dmcPeriods = [p * mixer_freq * 11 / 19687500
                 for p in [428, 380, 340, 320, 286, 254, 226, 214, 
                           190, 160, 142, 128, 106,  84,  72,  54]]
 
+# The synths step a channel only on samples where its period counter
+# periodcd runs out, and add the constant samples between steps as
+# one run.  While periodcd is at least 1, subtracting a whole number
+# from it is exact, so a run of n samples leaves periodcd where n
+# passes of a loop that subtracts 1 per sample would have, and the
+# output is the same to the bit.
+
+class LevelRuns(dict):
+    """Arrays of one level repeated length times, made on first use."""
+    def __init__(self, length):
+        dict.__init__(self)
+        self.length = length
+
+    def __missing__(self, level):
+        run = self[level] = array('h', [level]) * self.length
+        return run
+
 def synth_square_effect(snddata, samples_per_frame):
     phase = 0
     periodcd = 0
     out = array('h')
+    runs = LevelRuns(samples_per_frame)
+    append, extend = out.append, out.extend
     snddata = iter(snddata)
     while True:
         try:
@@ -45,22 +64,38 @@ def synth_square_effect(snddata, samples_per_frame):
             break
         duty = [1,2,4,6][(dutyvol >> 6) & 0x03]
         vol = 1000 * (dutyvol & 0x0F)
-        for s in xrange(samples_per_frame):
-            level = vol if phase < duty else 0
-            if periodcd < 1:
-                # simulated box filtering
-                phase = (phase + 1) % 8
-                level2 = vol if phase < duty else 0
-                level = level2 + int(max(0, periodcd) * (level - level2))
-                periodcd += period
+        samples = [vol] * duty + [0] * (8 - duty)
+        s = samples_per_frame
+        while True:
+            n = int(periodcd)
+            if n >= s:
+                extend(runs[samples[phase]][:s])
+                periodcd -= s
+                break
+            if n > 0:
+                extend(runs[samples[phase]][:n])
+                periodcd -= n
+                s -= n
+            elif s <= 0:
+                break
+            # simulated box filtering
+            level = samples[phase]
+            phase = (phase + 1) & 7
+            level2 = samples[phase]
+            frac = periodcd if periodcd > 0 else 0
+            level = level2 + int(frac * (level - level2))
+            periodcd += period
             periodcd -= 1
-            out.append(level)
+            append(level)
+            s -= 1
     return out
 
 def synth_triangle_effect(snddata, samples_per_frame):
     phase = 0
     periodcd = 0
     out = array('h')
+    runs = LevelRuns(samples_per_frame)
+    append, extend = out.append, out.extend
     snddata = iter(snddata)
     # triangle is balanced polarity
     samples = [1000*x for x in range(1, 17, 2)]
@@ -72,16 +107,29 @@ def synth_triangle_effect(snddata, samples_per_frame):
             period = notePeriods[next(snddata)] / 2
         except StopIteration:
             break
-        for s in xrange(samples_per_frame):
+        s = samples_per_frame
+        while True:
+            n = int(periodcd)
+            if n >= s:
+                extend(runs[samples[phase]][:s])
+                periodcd -= s
+                break
+            if n > 0:
+                extend(runs[samples[phase]][:n])
+                periodcd -= n
+                s -= n
+            elif s <= 0:
+                break
+            # simulated box filtering
             level = samples[phase]
-            if periodcd < 1:
-                # simulated box filtering
-                phase = (phase + 1) % 32
-                level2 = samples[phase]
-                level = level2 + int(max(0, periodcd) * (level - level2))
-                periodcd += period
+            phase = (phase + 1) & 31
+            level2 = samples[phase]
+            frac = periodcd if periodcd > 0 else 0
+            level = level2 + int(frac * (level - level2))
+            periodcd += period
             periodcd -= 1
-            out.append(level)
+            append(level)
+            s -= 1
 
     # anti-pop
     level = samples[phase]
@@ -93,6 +141,8 @@ def synth_noise_effect(snddata, samples_per_frame):
     shiftreg = 0x4321
     periodcd = 0
     out = array('h')
+    runs = LevelRuns(samples_per_frame)
+    append, extend = out.append, out.extend
     snddata = iter(snddata)
     lastlevel = 0
     while True:
@@ -105,18 +155,29 @@ def synth_noise_effect(snddata, samples_per_frame):
             break
         period = noisePeriods[dutyperiod & 0x0F]
         othertap = 6 if dutyperiod & 0x80 else 1
-        for s in xrange(samples_per_frame):
-            if periodcd < 1:
-                newbit = ((shiftreg >> othertap) ^ shiftreg) & 0x01
-                shiftreg = (shiftreg >> 1) | (newbit << 14)
-                level2 = vol if newbit else 0
-                level = level2 + int(max(0, periodcd) * (lastlevel - level2))
-                lastlevel = level2
-                periodcd += period
-            else:
-                level = lastlevel
+        s = samples_per_frame
+        while True:
+            n = int(periodcd)
+            if n >= s:
+                extend(runs[lastlevel][:s])
+                periodcd -= s
+                break
+            if n > 0:
+                extend(runs[lastlevel][:n])
+                periodcd -= n
+                s -= n
+            elif s <= 0:
+                break
+            newbit = ((shiftreg >> othertap) ^ shiftreg) & 0x01
+            shiftreg = (shiftreg >> 1) | (newbit << 14)
+            level2 = vol if newbit else 0
+            frac = periodcd if periodcd > 0 else 0
+            level = level2 + int(frac * (lastlevel - level2))
+            lastlevel = level2
+            periodcd += period
             periodcd -= 1
-            out.append(level)
+            append(level)
+            s -= 1
     return out
 
 def synth_ding(f):
@@ -128,71 +189,271 @@ def synth_ding(f):
                            * (length - t) / length))
                  for t in xrange(length)))
 
-def make_sound_effects(sfxdata):
+# Change when the synths' output changes so that effects cached
+# by an older version are made again
+SFX_CACHE_VERSION = 1
+
+def sfx_cache_key(ch, framelen, data):
+    """Hash everything that an effect's samples depend on."""
+    from hashlib import sha1
+
+    key = sha1(b"%d %d %d %d\n"
+               % (SFX_CACHE_VERSION, mixer_freq, ch, framelen))
+    key.update(bytes(data))
+    return key.hexdigest()
+
+def load_cached_effect(filename):
+    """Read an effect's samples saved by save_cached_effect().
+
+Raise IOError or OSError if the file is missing or ValueError if
+it is cut off in the middle of a sample.
+
+"""
+    import sys
+
+    samples = array('h')
+    with open(filename, 'rb') as infp:
+        samples.frombytes(infp.read())
+    if sys.byteorder != 'little':
+        samples.byteswap()
+    return samples
+
+def save_cached_effect(filename, samples):
+    """Write an effect's samples as 16-bit little-endian PCM."""
+    import os, sys
+
+    if sys.byteorder != 'little':
+        samples = array('h', samples)
+        samples.byteswap()
+    tmpfilename = filename + '.tmp'
+    with open(tmpfilename, 'wb') as outfp:
+        outfp.write(samples.tobytes())
+    os.replace(tmpfilename, filename)
+
+def prune_sfx_cache(cache_dir, keys):
+    """Remove cached effects whose key is not in keys."""
+    import os
+
+    for filename in os.listdir(cache_dir):
+        key, ext = os.path.splitext(filename)
+        if ext == '.pcm' and key not in keys:
+            os.remove(os.path.join(cache_dir, filename))
+
+def make_sound_effects(sfxdata, cache_dir=None):
+    """Synthesize sound effects.
+
+sfxdata -- iterable of (name, channel, frames per step, data)
+cache_dir -- if not None, a directory in which to keep each effect's
+samples, named by a hash of its channel, step length, data and
+mixer_freq, so that later calls with the same effects read them
+instead of synthesizing them again.  Files of effects not in
+sfxdata are removed.
+
+Return a dict from names to array('h') of samples.
+
+"""
+    import os
+
     baselen = mixer_freq // 60
     sfx = {}
+    keys = set()
+    if cache_dir:
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                cache_dir = None
     for (name, ch, framelen, data) in sfxdata:
+        if cache_dir:
+            key = sfx_cache_key(ch, framelen, data)
+            keys.add(key)
+            filename = os.path.join(cache_dir, key + '.pcm')
+            try:
+                sfx[name] = load_cached_effect(filename)
+                continue
+            except (IOError, OSError, ValueError):
+                pass
         synth = (synth_noise_effect
                  if ch >= 12
                  else synth_triangle_effect
                  if ch >= 8
                  else synth_square_effect)
         sfx[name] = synth(data, framelen*baselen)
+        if cache_dir:
+            try:
+                save_cached_effect(filename, sfx[name])
+            except (IOError, OSError):
+                pass
+    if cache_dir:
+        try:
+            prune_sfx_cache(cache_dir, keys)
+        except (IOError, OSError):
+            pass
     return sfx
 
 queued_fx = []
-logged_fx = []
 
 def fxq(sndname):
     queued_fx.append(sndname)
 
-def fxq_play(sfx, logtime):
+def fxq_play(players):
+    """Start the sound effects queued with fxq().
+
+players -- ApuPlayer or ApuMixer instances to play them on
+
+"""
     if not queued_fx:
         return
-    logged_fx.append((logtime, list(queued_fx)))
-    for sndname in queued_fx:
-        sfx[sndname].play()
+    for player in players:
+        player.play(queued_fx)
     queued_fx[:] = []
 
-def mixer_add2(dst, src, t):
-    d = array(b'h', (min(32765, max(-32765, a + b))
-                     for a, b in zip(src, dst[t:t + len(src)])))
-    dst[t:t + len(d)] = d
+def mix_span(pieces, length):
+    """Mix parts of effects that all cover one span of samples.
 
-def render_logged_fx(sfxdata, num_frames):
-    import sys
+pieces -- list of (array('h') of an effect's samples, index in it
+of the first sample of the span)
+length -- number of samples in the span
 
-    # Don't play identical FX on the same frame.
-    next_t_per_fx = {}
-    fxdeduped = []
-    for t, fxlist in sorted(logged_fx):
-        for fxname in fxlist:
-            new_t = max(t, next_t_per_fx.get(fxname, 0))
-            fxdeduped.append((new_t, fxname))
-            next_t_per_fx[fxname] = new_t + 1
-    new_t = fxlist = next_t_per_fx = None
-    
-    sys.stdout.write("Rendering %d sound effects" % len(fxdeduped))
-    sfx = make_sound_effects(sfxdata)
-    baselen = mixer_freq // 60
-    a = array(b'h', [0]) * (num_frames * baselen)
-    for t, fxname in fxdeduped:
-        sys.stdout.write('.')
-        mixer_add2(a, sfx.get(fxname, []), t * baselen)
-    sfx = fxdeduped = None
-
-    little = ord(array(b'h', [1]).tostring()[0])
-    if not little:
-        a.byteswap()
-
-    import wave
-    from contextlib import closing
-    with closing(wave.open('atee.wav', 'w')) as f:
-        f.setnchannels(1)
-        f.setsampwidth(2)
-        f.setframerate(mixer_freq)
-        f.writeframes(a.tostring())
-    sys.stdout.write(" done.\n")
+Where effects overlap, their samples are summed as Python ints and
+clipped once.  Elsewhere, the one effect's samples are copied.
+
+"""
+    if not pieces:
+        return array('h', [0]) * length
+    if len(pieces) == 1:
+        samples, start = pieces[0]
+        return samples[start:start + length]
+    spans = [samples[start:start + length] for (samples, start) in pieces]
+    return array('h', (min(32765, max(-32765, sum(s))) for s in zip(*spans)))
+
+class ApuMixer(object):
+    """Mix sound effects the way the NES's channels play them.
+
+Each effect plays on its channel from sfxdata: 0 or 4 for a pulse
+channel, 8 for triangle or 12 for noise.  Starting an effect cuts
+off whatever was playing on its channel, as a new sound effect
+takes over a channel on the NES, so effects on one channel never
+stack.  Effects started at the same time start in order, so the
+last one on each channel is heard.
+
+sfx -- dict from names to array('h') from make_sound_effects()
+sfxdata -- the sfxdata passed to make_sound_effects()
+
+"""
+    def __init__(self, sfx, sfxdata):
+        from collections import deque
+
+        self.sfx = sfx
+        self.channels = dict((name, ch) for (name, ch, framelen, data)
+                             in sfxdata)
+        self.voices = {}  # channel: [samples, index of next sample]
+        self.events = deque()  # (first sample, name), oldest first
+        self.time = 0  # samples rendered so far
+
+    def start(self, t, names):
+        """Start effects at sample t, or as soon as possible if t is
+already rendered.
+
+Calls must be in order of t.
+
+"""
+        self.events.extend((t, name) for name in names)
+
+    def play(self, names):
+        """Start effects at the next sample to be rendered."""
+        self.start(self.time, names)
+
+    def render(self, length):
+        """Return the next length samples of the mix as an array('h')."""
+        out = array('h')
+        end = self.time + length
+        voices = self.voices
+        while True:
+            while self.events and self.events[0][0] <= self.time:
+                name = self.events.popleft()[1]
+                if self.sfx.get(name):
+                    voices[self.channels.get(name, 0)] = [self.sfx[name], 0]
+            if self.time >= end:
+                return out
+
+            # Mix until the next effect starts or ends
+            span_end = end
+            if self.events:
+                span_end = min(span_end, self.events[0][0])
+            for (samples, i) in voices.values():
+                span_end = min(span_end, self.time + len(samples) - i)
+            n = span_end - self.time
+            out.extend(mix_span(list(voices.values()), n))
+            for ch in list(voices):
+                voice = voices[ch]
+                voice[1] += n
+                if voice[1] >= len(voice[0]):
+                    del voices[ch]
+            self.time = span_end
+
+class ApuPlayer(object):
+    """Play an ApuMixer through one pygame mixer channel.
+
+A background thread renders block_len samples at a time.  It queues
+each block on the channel while the block before it plays, so an
+effect starts at most two blocks after play() plus the mixer's own
+buffer.  While nothing is playing, the thread waits instead of
+rendering silence.
+
+"""
+    def __init__(self, mixer, block_len=mixer_freq // 60):
+        import threading
+        from queue import Queue
+
+        self.mixer, self.block_len = mixer, block_len
+        G.mixer.set_reserved(1)
+        self.channel = G.mixer.Channel(0)
+        self.names = Queue()
+        self.closing = False
+        self.renderer = threading.Thread(target=self.render_blocks)
+        self.renderer.daemon = True
+        self.renderer.start()
+
+    def play(self, names):
+        """Start sound effects by name."""
+        for name in names:
+            self.names.put(name)
+
+    def start_queued(self):
+        from queue import Empty
+
+        names = []
+        while True:
+            try:
+                names.append(self.names.get_nowait())
+            except Empty:
+                break
+        self.mixer.start(self.mixer.time, names)
+        return names
+
+    def render_blocks(self):
+        # Poll a few times per block, as pygame has no callback for
+        # when a queued sound starts
+        wait = self.block_len / mixer_freq / 4
+        while not self.closing:
+            if self.channel.get_queue() is not None:
+                sleep(wait)
+                continue
+            if not self.start_queued() and not self.mixer.voices:
+                sleep(wait)
+                continue
+            block = G.mixer.Sound(buffer=self.mixer.render(self.block_len))
+            if self.channel.get_busy():
+                self.channel.queue(block)
+            else:
+                self.channel.play(block)
+
+    def close(self):
+        """Stop the thread and the channel."""
+        self.closing = True
+        self.renderer.join()
+        self.channel.stop()
 
 splitsnd = array('B', [
     0x4f,36,0x44,36,0x4f,41,0x44,41,0x4f,46,0x44,46,0x44,36,0x42,36,
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+Compile levels for faster loading
+
+usage: compilelevels.py [LEVEL.map ...]
+
+Writes each level in the compiled level format next to it, with the
+extension .wbbl.  load_all_levels() uses the compiled file as long
+as it is at least as new as the .map file.
+
+"""
+from __future__ import with_statement, division, print_function, unicode_literals
+import sys
+
+def main(argv=None):
+    import argparse
+    import wbb
+    from levels import decode_level, compile_level, compiled_filename
+
+    parser = argparse.ArgumentParser(
+        description="Compile .map levels to memory-mappable .wbbl files."
+    )
+    parser.add_argument("levels", nargs="*", default=wbb.level_filenames,
+                        help="level files to compile (default: the game's levels)")
+    parser.add_argument("--height", type=int, default=12,
+                        help="rows in each column")
+    args = parser.parse_args((argv or sys.argv)[1:])
+    for filename in args.levels:
+        with open(filename, 'rb') as infp:
+            level = decode_level(infp.read())
+        outfilename = compiled_filename(filename)
+        with open(outfilename, 'wb') as outfp:
+            outfp.write(compile_level(level, args.height))
+        print("%s -> %s" % (filename, outfilename))
+
+if __name__=='__main__':
+    main()
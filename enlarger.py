@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import sys
 import pygame as G
 
 class Enlarger(object):
@@ -17,11 +18,41 @@ flip_after -- if True, flip() chains to pygame.display.flip()
         self.videotee_fp = None
         self.videotee_skip = 1
         self.videotee_left = 0
+        self.videotee_frames = 0  # frames written to the video tee
+        self.audiotee_fp = None
+        self.audiotee_samples = 0  # samples written to the audio tee
         self.num_frames = 0
 
     def set_videotee(self, outfp, divisor=1):
         self.videotee_fp = outfp
         self.videotee_skip = divisor
+        self.videotee_left = self.videotee_frames = 0
+
+    def set_audiotee(self, outfp, render, samples_per_frame):
+        """Write audio for each frame in step with the video tee.
+
+outfp -- an open wave.Wave_write for 16-bit mono
+render -- called with samples_per_frame at each flip(), returning
+an array('h') of the samples for that frame
+
+Every flip writes samples_per_frame samples, whether or not the
+video tee writes that frame, so the audio and video streams end up
+the same length and need no timestamps to line up.
+
+"""
+        self.audiotee_fp = outfp
+        self.audiotee_render = render
+        self.audiotee_len = samples_per_frame
+        self.audiotee_samples = 0
+
+    def tee_lengths_match(self):
+        """Return True if the audio tee has exactly as many samples as
+the frames written to the video tee span.
+
+"""
+        return (self.audiotee_samples
+                == self.videotee_frames * self.videotee_skip
+                   * self.audiotee_len)
 
     def get_surface(self):
         return self.src or self.dst
@@ -38,5 +69,12 @@ flip_after -- if True, flip() chains to pygame.display.flip()
                 bottom_up = False
                 s = G.image.tostring(self.get_surface(), "RGB", bottom_up)
                 self.videotee_fp.write(s)
+                self.videotee_frames += 1
             self.videotee_left -= 1
+        if self.audiotee_fp:
+            samples = self.audiotee_render(self.audiotee_len)
+            if sys.byteorder != 'little':
+                samples.byteswap()
+            self.audiotee_fp.writeframes(samples.tobytes())
+            self.audiotee_samples += len(samples)
         self.num_frames += 1
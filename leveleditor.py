@@ -5,6 +5,7 @@ import levels
 
 with_double = True
 mixer_freq = 44100  # for preview
+autosave_frames = 600  # write changes this often; 0 to disable
 
 tile_descriptions = [
     'empty',
@@ -48,92 +49,324 @@ def pf_update_cols(pf, cols, xleft, xright=None, with_markov=True):
     xright = min(pf.win_x + 32, xright)
     if xleft >= xright:
         return
-    empty_col = [0]*12
-    m = levels.markov
+    empty_col = bytearray(12)
     for x in range(xleft, xright):
         col = cols[x] if x < len(cols) else empty_col
-        last_p = 0
-        for y, p in enumerate(col):
-            if with_markov:
-                p = p or (m[last_p] if last_p < len(m) else 0)
-            last_p = p
-            pf.setcell(x, y, p)
+        if with_markov:
+            col = levels.markov_fill(col)
+        pf.setcol(x, 0, col)
 
 def markov_fill_and_unfill(col):
-    import array
-    filled = bytearray()
-    unfilled = bytearray()
-    last_p = 0
-    m = levels.markov
-    for tileno in col:
-        pred = m[last_p] if last_p < len(m) else 0
-        last_p = tileno or pred
-        filled.append(last_p)
-        unfilled.append(last_p if last_p != pred else 0)
+    filled = levels.markov_fill(col)
+    # What markov predicts for each cell from the filled cell above
+    pred = (b'\x00' + bytes(filled[:-1])).translate(levels.markov_table)
+    unfilled = bytearray(f if f != p else 0 for (f, p) in zip(filled, pred))
     return filled, unfilled
 
+def markov_optimize_row(row, free):
+    """Find the fewest words for one row when strips may cross cells.
+
+row -- filled tile of each cell of the row
+free -- for each cell, True if markov fill predicts its tile, so
+it may be left empty
+
+A word places one tile, and a strip of 3 to 16 cells costs 2 words.
+A later word replaces what a strip put in a cell, so a strip may
+run across cells of other tiles if words after it fix them.  Finds
+the cheapest such layout, with strips that don't overlap, by
+working from the right end of the row.  Return (number of words,
+layout) in the order the words must be written, with (x, tile, 0)
+for a single tile and (x, tile, n) for a strip of n more cells.
+
+"""
+    n = len(row)
+    # A strip saves words only where its tile would otherwise need a
+    # word of its own, so only tiles needed 3 or more times can save,
+    # and their strips need only start and end on such cells
+    needed_at = {}
+    for (x, tile) in enumerate(row):
+        if not free[x]:
+            needed_at.setdefault(tile, []).append(x)
+    strips = {}  # start: [(tile, end, cells the strip gets wrong)]
+    for (t, xs) in needed_at.items():
+        if len(xs) < 3:
+            continue
+        # wrong[x] is the number of cells left of x that a strip of t
+        # would get wrong
+        wrong = [0]
+        for (x, tile) in enumerate(row):
+            wrong.append(wrong[-1] + (tile != t and not (t == 0 and free[x])))
+        for (i, x) in enumerate(xs):
+            for xe in xs[i + 2:]:
+                if xe - x >= 16:
+                    break
+                strips.setdefault(x, []).append(
+                    (t, xe + 1, wrong[xe + 1] - wrong[x])
+                )
+
+    cost = [0] * (n + 1)
+    choice = [None] * n
+    for x in range(n - 1, -1, -1):
+        cost[x] = cost[x + 1] + (0 if free[x] else 1)
+        for (t, end, nwrong) in strips.get(x, ()):
+            c = 2 + nwrong + cost[end]
+            if c < cost[x]:
+                cost[x], choice[x] = c, (t, end)
+
+    layout = []
+    x = 0
+    while x < n:
+        if choice[x] is None:
+            if not free[x]:
+                layout.append((x, row[x], 0))
+            x += 1
+            continue
+        t, end = choice[x]
+        layout.append((x, t, end - x - 1))
+        layout.extend((xn, row[xn], 0) for xn in range(x + 1, end)
+                      if row[xn] != t and not (t == 0 and free[xn]))
+        x = end
+    return cost[0], layout
+
 def markov_optimize_screen(cols):
-    cols = [markov_fill_and_unfill(col) for col in cols]
-    filled = [col[0] for col in cols]
-    unfilled = [(x, y, c)
-                for (x, col) in enumerate(cols)
-                for (y, c) in enumerate(col[1])
-                if c]
-
-    # Right now, an object file can be created from unfilled.
-    # But first let's bucket sort them by Y so that we can find runs
-    # of a given row that cover at least 3 unfilled.  The objects
-    # are already sorted by X; sorting them by Y preserves this.
-    byrow = [[] for i in range(12)]
-    for (x, y, c) in unfilled:
-        byrow[y].append((x, c))
+    """Encode up to 16 columns as screen words.
+
+Only tiles that markov fill would not predict need words.  In each
+run of a row where the filled tiles are all the same, 3 or more such
+tiles cost less as one strip (2 words) over the whole run than as
+single tiles.  A strip that crosses other tiles can do better only
+where one tile has 3 or more such tiles in more than one run, so
+only those rows go to markov_optimize_row(), and its layout is used
+only if it takes fewer words.
+
+"""
+    import re
+    import array
+
+    if not cols:
+        return array.array('H')
+    h, ncols = len(cols[0]), len(cols)
+    # Lay the filled tiles out a row at a time so that the tiles
+    # needing words come out sorted by row and then column
+    filled = b''.join(bytes(levels.markov_fill(col)) for col in cols)
+    filled = b''.join(filled[y::h] for y in range(h))
+    # What markov predicts for each cell from the filled cell above
+    pred = (bytes(ncols) + filled[:-ncols]).translate(levels.markov_table)
+    # Cells whose tile differs from the prediction need words
+    diff = (int.from_bytes(filled, 'big') ^ int.from_bytes(pred, 'big'))
+    diff = diff.to_bytes(len(filled), 'big')
+    needed = [divmod(m.start(), ncols)
+              for m in re.finditer(b'[^\x00]', diff)]
+
     objs = []
-    for (y, row) in enumerate(byrow):
-        i = 0
-        while i < len(row):
-            x, c = row[i]
-
-            # if there aren't 2 more like objects after this
-            # on this row, emit a single tile
-            if (i + 3 > len(row)
-                or row[i + 1][1] != c
-                or row[i + 2][1] != c):
-                objs.append((x, y, c))
-                i += 1
-                continue
-
-            # So we know the next two objects on this row are the
-            # same tile number.  Search for how many are contiguous
-            # in the filled data.
-            xr = x + 1
-            while xr < len(filled) and filled[xr][y] == c:
-                xr += 1
-
-            # If the run is not long enough, emit a single tile
-            if row[i + 2][0] >= xr:
-                objs.append((x, y, c))
-                i += 1
-                continue
-
-            # Extend run to left for editor's convenience
-            while x > 0 and filled[x - 1][y] == c:
-                x -= 1
-
-            # Now subsume all objs within this run
-            oldi = i + 3
-            while i < len(row) and row[i][0] < xr:
-                i += 1
-            objs.append((x, y, c))
+    rowobjs = []
+    runs_per_tile = {}  # tile: [needed tiles in row, runs they are in]
+    i = 0
+    while i < len(needed):
+        y, x = needed[i]
+        rowstart = y * ncols
+        c = filled[rowstart + x]
+        # Find the run of this tile around x and the needed tiles in it
+        xl, xr = x, x + 1
+        while xl > 0 and filled[rowstart + xl - 1] == c:
+            xl -= 1
+        while xr < ncols and filled[rowstart + xr] == c:
+            xr += 1
+        j = i + 1
+        while j < len(needed) and needed[j][0] == y and needed[j][1] < xr:
+            j += 1
+        if j - i >= 3:
+            # Strips start at the left of the run for the editor's
+            # convenience
+            rowobjs.append((xl, y, c))
             # Y=12 and X=0 means a run of tileno (2-15) more tiles
-            objs.append((0, 12, xr - x - 1))
+            rowobjs.append((0, 12, xr - xl - 1))
+        else:
+            rowobjs.extend((xn, y, c) for (yn, xn) in needed[i:j])
+        counts = runs_per_tile.setdefault(c, [0, 0])
+        counts[0] += j - i
+        counts[1] += 1
+        i = j
+
+        if i < len(needed) and needed[i][0] == y:
+            continue
+        # End of row: try strips across runs if they might help
+        if any(n >= 3 and runs > 1 for (n, runs) in runs_per_tile.values()):
+            rowend = rowstart + ncols
+            free = [not d for d in diff[rowstart:rowend]]
+            cost, layout = markov_optimize_row(filled[rowstart:rowend], free)
+            if cost < len(rowobjs):
+                rowobjs = []
+                for (x, tile, n) in layout:
+                    rowobjs.append((x, y, tile))
+                    if n:
+                        rowobjs.append((0, 12, n))
+        objs.extend(rowobjs)
+        rowobjs = []
+        runs_per_tile.clear()
 
     # And at this point, we're ready to encode it
-    import array
     screendata = array.array('H', (
         (y << 12) | (x << 8) | c for (x, y, c) in objs
     ))
     return screendata
 
+class EditColumns(object):
+    """Columns of a level being edited, decoded a screen at a time.
+
+Indexing returns a bytearray of one column's tiles before markov
+fill.  Change tiles with setcell(), insert() and del so that
+encode_screens() knows which screens to encode again.
+
+level -- level data structure
+
+"""
+    def __init__(self, level):
+        self.level = level
+        self.screens = list(level['screens'])
+        # 16 columns per screen, or None until a column is used.
+        # Screens before the first insert or delete are never moved,
+        # so an undecoded screen is still at its index in level.
+        self.decoded = [None] * len(self.screens)
+        self.num_cols = 16 * len(self.screens)
+        self.dirty = set()
+        self.changed = False
+
+    def __len__(self):
+        return self.num_cols
+
+    def get_screen(self, scrnum):
+        cols = self.decoded[scrnum]
+        if cols is None:
+            from levels import load_level_col
+            cols = self.decoded[scrnum] = [
+                load_level_col(None, self.level, x)
+                for x in range(16 * scrnum, 16 * scrnum + 16)
+            ]
+        return cols
+
+    def __getitem__(self, x):
+        if not 0 <= x < self.num_cols:
+            raise IndexError("column %d out of range" % x)
+        return self.get_screen(x // 16)[x % 16]
+
+    def setcell(self, x, y, tileno):
+        self[x][y] = tileno
+        self.dirty.add(x // 16)
+        self.changed = True
+
+    def splice(self, x, fn):
+        """Change the number of columns at x.
+
+fn -- called with a list of all columns from x's screen on and the
+index of x in it, and changes the list in place
+
+"""
+        first = x // 16
+        cols = [col for s in range(first, len(self.decoded))
+                for col in self.get_screen(s)]
+        fn(cols, x - 16 * first)
+        self.num_cols = 16 * first + len(cols)
+        self.decoded[first:] = [cols[i:i + 16]
+                                for i in range(0, len(cols), 16)]
+        del self.screens[len(self.decoded):]
+        self.screens.extend([None] * (len(self.decoded) - len(self.screens)))
+        self.dirty = set(s for s in self.dirty if s < first)
+        self.dirty.update(range(first, len(self.decoded)))
+        self.changed = True
+
+    def insert(self, x, col):
+        self.splice(x, lambda cols, i: cols.insert(i, col))
+
+    def __delitem__(self, x):
+        def delete(cols, i):
+            del cols[i]
+        self.splice(x, delete)
+
+    def encode_screens(self):
+        """Encode screens changed since the last call.
+
+Return a list of the words of all screens.
+
+"""
+        for scrnum in self.dirty:
+            self.screens[scrnum] = markov_optimize_screen(self.decoded[scrnum])
+        self.dirty.clear()
+        self.changed = False
+        return list(self.screens)
+
+class LevelSaver(object):
+    """Write levels to a file in a background thread.
+
+If save() is called again before the thread gets to a level, only
+the newest level is written.  Each level is written to a temporary
+file that then replaces filename, so a crash leaves the last
+complete save.  If writing fails, the error is raised from the next
+call to save() or close().
+
+"""
+    def __init__(self, filename):
+        import threading
+        from queue import Queue
+
+        self.filename = filename
+        self.error = None  # exception from the thread not yet raised
+        self.queue = Queue()
+        self.writer = threading.Thread(target=self.write_levels)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def write_levels(self):
+        from queue import Empty
+
+        closing = False
+        while not closing:
+            level = self.queue.get()
+            while True:
+                try:
+                    newer = self.queue.get_nowait()
+                except Empty:
+                    break
+                if newer is None:
+                    closing = True
+                else:
+                    level = newer
+            if level is None:
+                break
+            try:
+                self.write_level(level)
+            except Exception as e:
+                self.error = e
+
+    def raise_error(self):
+        error, self.error = self.error, None
+        if error:
+            raise error
+
+    def write_level(self, level):
+        import os
+
+        tmpfilename = self.filename + '.tmp'
+        with open(tmpfilename, 'wb') as outfp:
+            outfp.write(levels.encode_level(level))
+        os.replace(tmpfilename, self.filename)
+
+    def save(self, level):
+        """Queue a level data structure to be written.
+
+Raise the error from an earlier write that failed, if any.  The
+level is still queued.
+
+"""
+        self.queue.put(level)
+        self.raise_error()
+
+    def close(self):
+        """Write the last level queued and stop the thread."""
+        self.queue.put(None)
+        self.writer.join()
+        self.raise_error()
+
 def update_camxvel(vel, dist):
     # If not same sign, brake
     if vel < 0 and dist >= 0:
@@ -243,7 +476,7 @@ class Editor(Activity):
         self.camera = SmoothpanCamera()
         self.target_camx = 0
         self.tileno = 2
-        self.cols = []
+        self.cols = EditColumns(make_empty_level())
         self.mousemove_xy = None
         self.actions = []
 
@@ -258,7 +491,7 @@ class Editor(Activity):
                        xbase, xbase + 17, with_markov=self.with_markov)
 
     def load_cols_from_level(self, level):
-        self.cols = decode_entire_level(level)
+        self.cols = EditColumns(level)
         self.update_all_cols()
 
     def move_camera(self):
@@ -388,7 +621,7 @@ class Editor(Activity):
         elif e0 == 'placetile':
             t_x, t_y = event[1:3]
             if 0 <= t_x < len(self.cols) and 0 <= t_y < 12:
-                self.cols[t_x][t_y] = self.tileno
+                self.cols.setcell(t_x, t_y, self.tileno)
                 pf_update_cols(self.pf, self.cols, t_x, with_markov=self.with_markov)
         elif e0 == 'pickuptile':
             t_x, t_y = event[1:3]
@@ -514,13 +747,22 @@ class TilePicker(Activity):
         self.dirty_tiles = set()
         
 
-def runonce(enl, font, vwf, level):
+def runonce(enl, font, vwf, level, saver=None):
+    """Edit a level until the user closes the editor.
+
+saver -- a LevelSaver to write changes to every autosave_frames
+frames, or None
+
+Return the edited level data structure.
+
+"""
     sheet = G.image.load('tilesets/bgtiles.png').convert()
     context = (enl.get_surface(), sheet, font, vwf)
     e = Editor(context)
     e.load_cols_from_level(level)
     clk = G.time.Clock()
     backstack = [e]
+    frames_to_autosave = autosave_frames
     while backstack:
         fm = backstack[-1]
         actions = [fm.event_to_action(event) for event in G.event.get()]
@@ -538,10 +780,18 @@ def runonce(enl, font, vwf, level):
                 backstack[-1].uncover()
         if fm.quitting and backstack:
             backstack[-1].handle_action(('quit',))
+        frames_to_autosave -= 1
+        if saver and autosave_frames and frames_to_autosave <= 0:
+            frames_to_autosave = autosave_frames
+            if e.cols.changed:
+                try:
+                    saver.save({'screens': e.cols.encode_screens(),
+                                'start': level['start']})
+                except (IOError, OSError) as err:
+                    print("autosave failed:", err)
 
     lvltosave = {
-        'screens': [markov_optimize_screen(e.cols[i:i + 16])
-                    for i in range(0, len(e.cols), 16)],
+        'screens': e.cols.encode_screens(),
         'start': level['start']
     }
     return lvltosave
@@ -578,14 +828,15 @@ def main():
             raise
 
     lvldata = levels.decode_level(lvldata) if lvldata else make_empty_level()
-    lvltosave = runonce(enl, font, vwf, lvldata)
-
-    enl.get_surface().fill((102, 102, 102))
-    font.textout(enl.get_surface(), 'Saving', 32, 16)
-    enl.flip()
-    lvldata = levels.encode_level(lvltosave)
-    with open("levels/editor.map", 'wb') as outfp:
-        outfp.write(lvldata)
+    saver = LevelSaver("levels/editor.map")
+    try:
+        lvltosave = runonce(enl, font, vwf, lvldata, saver)
+        enl.get_surface().fill((102, 102, 102))
+        font.textout(enl.get_surface(), 'Saving', 32, 16)
+        enl.flip()
+        saver.save(lvltosave)
+    finally:
+        saver.close()
 
     import wbb
     wbb.level_filenames[:] = ["levels/editor.map"]
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 from __future__ import with_statement, unicode_literals
 from array import array
+from struct import Struct
 import json
+import sys
 try:
     StandardError
 except NameError:
@@ -17,6 +19,59 @@ markov = [
     0, 0, 0, 0, 0, 0, 0, 0
 ]
 
+# markov extended to all 256 tile numbers with 0, for bytes.translate()
+markov_table = bytes(bytearray(markov + [0] * (256 - len(markov))))
+
+# markov_runs[t][:n] is what fills n empty cells below tile t
+MARKOV_RUN_LEN = 32
+def make_markov_runs(run_len=MARKOV_RUN_LEN):
+    runs = []
+    for t in range(256):
+        run = bytearray()
+        for i in range(run_len):
+            t = markov_table[t]
+            run.append(t)
+        runs.append(bytes(run))
+    return runs
+markov_runs = make_markov_runs()
+
+# Filled columns by unfilled column, as levels reuse a few columns a lot
+markov_filled_cols = {}
+MARKOV_FILLED_COLS_MAX = 4096
+
+def markov_fill(col, last_tile=0):
+    """Fill the empty cells of a column the way the NES version does.
+
+col -- tile numbers from top to bottom, with 0 for empty
+last_tile -- tile above the top of col
+
+Return a bytearray of the filled column.
+
+"""
+    key = bytes(bytearray(col))
+    if not last_tile:
+        try:
+            return bytearray(markov_filled_cols[key])
+        except KeyError:
+            pass
+    filled = bytearray(key)
+    n = len(filled)
+    start = filled.find(b'\x00')
+    while start >= 0:
+        end = n - len(filled[start:].lstrip(b'\x00'))
+        above = filled[start - 1] if start else last_tile
+        if end - start <= MARKOV_RUN_LEN:
+            filled[start:end] = markov_runs[above][:end - start]
+        else:
+            for y in range(start, end):
+                above = filled[y] = markov_table[above]
+        start = filled.find(b'\x00', end)
+    if not last_tile:
+        if len(markov_filled_cols) >= MARKOV_FILLED_COLS_MAX:
+            markov_filled_cols.clear()
+        markov_filled_cols[key] = bytes(filled)
+    return filled
+
 # Screen data format
 # 0x0000-0xBFFF: place tile
 #   yyyyxxxxtttttttt
@@ -27,40 +82,159 @@ markov = [
 #   110000000000nnnn
 #   n: number of additional tiles, that is, strip length - 1
 
+# Compiled level format (.wbbl), all numbers little-endian
+# header: magic 'WBBL', version, column height, CRC-32 of the
+#   markov_table the columns were filled with, then offset and
+#   length of each of the three sections
+# JSON section: the same JSON as in a .map file
+# screens section: the screens' words, big-endian as in a .map file
+# columns section: markov-filled columns as packed by LevelColumns
+COMPILED_MAGIC = b'WBBL'
+COMPILED_VERSION = 2
+compiled_header = Struct('<4sHHI6I')
+
+# Level pack format (.wbbp), all numbers little-endian
+# header: magic 'WBBP', version, number of levels
+# index: for each level, offset and length of its data, length of
+#   its name, and the name in UTF-8
+# level data: each level in the same format as a .map file
+PACK_MAGIC = b'WBBP'
+PACK_VERSION = 1
+pack_header = Struct('<4sHI')
+pack_index_entry = Struct('<IIH')
+
 def encode_level(level):
     level = dict(level)  # defensive copy when replacing screens
+    level.pop('column_cache', None)
     screens = level['screens']
     level['screens'] = [len(s) for s in screens]
     level = json.dumps(level, separators=(',', ':')).encode('utf-8')
-    screenwords = (b
-                   for s in screens
-                   for w in s
-                   for b in ((w >> 8) & 0xFF, w & 0xFF))
-    level = b"%d\n%s%s" % (len(level), level, bytes(screenwords))
+    screenwords = array('H')
+    for s in screens:
+        screenwords.extend(s)
+    if sys.byteorder != 'big':
+        screenwords.byteswap()
+    level = b"%d\n%s%s" % (len(level), level, screenwords.tobytes())
     return level
 
+def split_screens(data, scrlens):
+    """Split big-endian words into one array('H') per screen.
+
+data -- bytes of the words of all screens, one after another
+scrlens -- number of words in each screen
+
+"""
+    words = array('H')
+    words.frombytes(data[:len(data) // 2 * 2])
+    if len(words) < sum(scrlens):
+        raise ValueError("level has %d words of screen data; expected %d"
+                         % (len(words), sum(scrlens)))
+    if sys.byteorder != 'big':
+        words.byteswap()
+    screens = []
+    start = 0
+    for scrlen in scrlens:
+        screens.append(words[start:start + scrlen])
+        start += scrlen
+    return screens
+
 def decode_level(level):
     jsonlen, rest = level.split(b'\n', 1)
     jsonlen = int(jsonlen.decode('ascii'))
     level = json.loads(rest[:jsonlen].decode('utf-8'))
-    lbytes = bytearray(rest[jsonlen:])
-    lwds = (((lbytes[i] << 8) | lbytes[i + 1]
-             for i in range(0, len(lbytes), 2)))
-    screens = [array('H', (next(lwds) for i in range(scrlen)))
-               for scrlen in level['screens']]
-    level['screens'] = screens
+    level['screens'] = split_screens(rest[jsonlen:], level['screens'])
     level['start'] = tuple(level['start'])
     return level
 
+class LevelColumns(object):
+    """Markov-filled columns of a level, decoded a screen at a time.
+
+Each column is height bytes, and all columns are packed end to end
+in one bytearray.  Indexing returns a memoryview of one column.
+Use for_level() to share one instance among all attempts at a level.
+
+level -- level data structure
+height -- number of rows in each column
+data -- if not None, a buffer of all columns already decoded, such
+as from a compiled level
+
+"""
+    def __init__(self, level, height=12, data=None):
+        self.screens = level['screens']
+        self.height = height
+        if data is None:
+            self.data = bytearray(16 * height * len(self.screens))
+            self.decoded = [False] * len(self.screens)
+        else:
+            self.data = data
+            self.decoded = [True] * len(self.screens)
+        self.view = memoryview(self.data)
+        self.empty_col = memoryview(bytes(bytearray(height)))
+
+    @classmethod
+    def for_level(cls, level, height=12):
+        """Get the columns of level, decoding them on first use.
+
+The instance is kept in level['column_cache'].
+
+"""
+        self = level.get('column_cache')
+        if self is None or self.height != height:
+            self = level['column_cache'] = cls(level, height)
+        return self
+
+    def decode_screen(self, scrnum):
+        h = self.height
+        start = scrnum * 16 * h
+        cols = bytearray(16 * h)
+        tx = ty = tn = 0
+        for w in self.screens[scrnum]:
+            if w < 0xC000:
+                ty = w >> 12
+                tx = (w >> 8) & 0x0F
+                tn = w & 0xFF
+                if ty >= h:
+                    continue  # below the playfield
+                cols[tx * h + ty] = tn
+            elif w < 0xC010 and ty < h:
+                for x in range(tx + 1, min(16, tx + 1 + (w & 0x0F))):
+                    cols[x * h + ty] = tn
+        for colstart in range(0, 16 * h, h):
+            cols[colstart:colstart + h] = markov_fill(cols[colstart:colstart + h])
+        self.data[start:start + 16 * h] = cols
+        self.decoded[scrnum] = True
+
+    def __len__(self):
+        return 16 * len(self.screens)
+
+    def __getitem__(self, x):
+        scrnum = x // 16
+        if not 0 <= scrnum < len(self.screens):
+            return self.empty_col
+        if not self.decoded[scrnum]:
+            self.decode_screen(scrnum)
+        start = x * self.height
+        return self.view[start:start + self.height]
+
 def load_level_col(pf, level, x, use_markov=True):
     """
 
-pf -- MetatilePlane.instance to write back to
+pf -- MetatilePlane.instance to write back to, or None to return
+the column without markov fill
 level -- level data structure
 x -- column number
 
+Return the column's tiles: with pf and use_markov, a memoryview of
+the filled column from LevelColumns, otherwise a bytearray of the
+tiles before markov fill.
+
 """
-    col = bytearray(12)
+    if pf and use_markov:
+        col = LevelColumns.for_level(level, pf.height)[x]
+        pf.setcol(x, 0, col)
+        return col
+
+    col = bytearray(pf.height if pf else 12)
     tx = ty = tn = 0
     xinpage = x % 16
     try:
@@ -77,22 +251,186 @@ x -- column number
         elif w < 0xC010:
             if tx < xinpage <= tx + (w & 0x0F):
                 col[ty] = tn
-    last_ty = 0
-    for y, ty in enumerate(col):
-        if use_markov:
-            ty = ty or markov[last_ty]
-        last_ty = ty
-        if pf:
-            pf.setcell(x, y, ty)
+    if pf:
+        pf.setcol(x, 0, col)
     return col
 
 def load_level(pf, level):
-    for x in range(32):
+    for x in range(pf.width):
         load_level_col(pf, level, x)
 
+def markov_table_crc():
+    from zlib import crc32
+    return crc32(markov_table) & 0xFFFFFFFF
+
+def compile_level(level, height=12):
+    """Convert a level data structure to the compiled level format."""
+    jsonlen, rest = encode_level(level).split(b'\n', 1)
+    jsonlen = int(jsonlen.decode('ascii'))
+    jsondata, screendata = rest[:jsonlen], rest[jsonlen:]
+    columns = LevelColumns(level, height)
+    for scrnum in range(len(columns.screens)):
+        columns.decode_screen(scrnum)
+    offset = compiled_header.size
+    sections = []
+    for data in (jsondata, screendata, columns.data):
+        sections.extend((offset, len(data)))
+        offset += len(data)
+    return b''.join([
+        compiled_header.pack(COMPILED_MAGIC, COMPILED_VERSION, height,
+                             markov_table_crc(), *sections),
+        jsondata, screendata, bytes(columns.data)
+    ])
+
+def load_compiled_level(filename):
+    """Load a level in the compiled level format.
+
+The file is memory-mapped, and its columns become the level's
+LevelColumns without being copied or decoded.
+
+Raise ValueError if the file is not a compiled level of this
+version, is cut off, or was filled with a different markov table.
+
+"""
+    import mmap
+
+    with open(filename, 'rb') as infp:
+        data = mmap.mmap(infp.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(data) < compiled_header.size:
+        raise ValueError("%s: too short for a compiled level" % filename)
+    header = compiled_header.unpack_from(data)
+    (magic, version, height, markov_crc, jsonstart, jsonlen,
+     screenstart, screenlen, colstart, collen) = header
+    if magic != COMPILED_MAGIC or version != COMPILED_VERSION:
+        raise ValueError("%s: not a version %d compiled level"
+                         % (filename, COMPILED_VERSION))
+    if markov_crc != markov_table_crc():
+        raise ValueError("%s: compiled with a different markov table"
+                         % filename)
+    for (start, length) in ((jsonstart, jsonlen), (screenstart, screenlen),
+                            (colstart, collen)):
+        if start + length > len(data):
+            raise ValueError("%s: cut off; expected %d bytes, found %d"
+                             % (filename, start + length, len(data)))
+    level = json.loads(data[jsonstart:jsonstart + jsonlen].decode('utf-8'))
+    level['screens'] = split_screens(data[screenstart:screenstart + screenlen],
+                                     level['screens'])
+    level['start'] = tuple(level['start'])
+    if collen != height * 16 * len(level['screens']):
+        raise ValueError("%s: %d bytes of columns; expected %d"
+                         % (filename, collen,
+                            height * 16 * len(level['screens'])))
+    coldata = memoryview(data)[colstart:colstart + collen]
+    level['column_cache'] = LevelColumns(level, height, coldata)
+    return level
+
+def compiled_filename(filename):
+    import os
+    return os.path.splitext(filename)[0] + '.wbbl'
+
+def write_level_pack(filename, named_levels):
+    """Write levels to a level pack.
+
+named_levels -- iterable of (name, level data in .map format)
+
+"""
+    named_levels = [(name.encode('utf-8'), data)
+                    for (name, data) in named_levels]
+    offset = pack_header.size + sum(pack_index_entry.size + len(name)
+                                    for (name, data) in named_levels)
+    index = []
+    for (name, data) in named_levels:
+        index.append(pack_index_entry.pack(offset, len(data), len(name)))
+        index.append(name)
+        offset += len(data)
+    with open(filename, 'wb') as outfp:
+        outfp.write(pack_header.pack(PACK_MAGIC, PACK_VERSION,
+                                     len(named_levels)))
+        outfp.writelines(index)
+        outfp.writelines(data for (name, data) in named_levels)
+
+class LevelPack(object):
+    """Levels in a level pack, decoded when first used.
+
+Works as a read-only list of level data structures, in the order
+they were packed.  Only the index is read up front.  At most
+max_loaded decoded levels are kept, and the least recently used is
+dropped to make room for another.
+
+"""
+    def __init__(self, filename, max_loaded=16):
+        from collections import OrderedDict
+
+        self.fp = open(filename, 'rb')
+        magic, version, num_levels = pack_header.unpack(
+            self.fp.read(pack_header.size)
+        )
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            raise ValueError("%s: not a version %d level pack"
+                             % (filename, PACK_VERSION))
+        self.names, self.extents = [], []
+        for i in range(num_levels):
+            offset, length, namelen = pack_index_entry.unpack(
+                self.fp.read(pack_index_entry.size)
+            )
+            self.names.append(self.fp.read(namelen).decode('utf-8'))
+            self.extents.append((offset, length))
+        self.max_loaded = max_loaded
+        self.loaded = OrderedDict()
+
+    def close(self):
+        self.fp.close()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        i = range(len(self.names))[i]
+        try:
+            level = self.loaded.pop(i)
+        except KeyError:
+            offset, length = self.extents[i]
+            self.fp.seek(offset)
+            level = decode_level(self.fp.read(length))
+            while len(self.loaded) >= self.max_loaded:
+                self.loaded.popitem(last=False)
+        self.loaded[i] = level
+        return level
+
+    def index(self, name):
+        """Get the position of the level with a given name."""
+        return self.names.index(name)
+
 def load_all_levels(level_filenames):
+    """Load levels from .map files.
+
+If a compiled level (.wbbl) next to a .map file is at least as new,
+or the .map file is missing, the compiled level is loaded instead.
+A compiled level that load_compiled_level() rejects is skipped in
+favor of the .map file if there is one.
+
+"""
+    import os
+
     all_levels = []
     for filename in level_filenames:
+        cfilename = compiled_filename(filename)
+        try:
+            cmtime = os.path.getmtime(cfilename)
+        except OSError:
+            cmtime = None
+        try:
+            use_compiled = (cmtime is not None
+                            and cmtime >= os.path.getmtime(filename))
+        except OSError:
+            use_compiled = cmtime is not None
+        if use_compiled:
+            try:
+                all_levels.append(load_compiled_level(cfilename))
+                continue
+            except ValueError:
+                if not os.path.exists(filename):
+                    raise
         with open(filename, 'rb') as infp:
             lvldata = infp.read()
         all_levels.append(decode_level(lvldata))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Play a directory of movies with no display and report how each ended
+
+usage: movieverify.py [-j JOBS] [-n NOTICES] MOVIEDIR [LEVEL.map ...]
+
+Each movie is a file in the same format as tasrec.txt.  Movies are
+spread across a pool of worker processes, and one line is printed
+for each movie in name order.
+
+If a movie has a trace of state hashes with the same name ending in
+.trace, recorded with wbb.movietrace_filename, the line also shows
+the first frame where the replay's state differs from the trace.
+
+"""
+from __future__ import with_statement, division, print_function, unicode_literals
+import os
+import sys
+
+# Levels and notice count used by each worker process
+worker_levels = None
+worker_notices = 0
+
+def init_worker(level_filenames, notices):
+    from levels import load_all_levels
+    global worker_levels, worker_notices
+
+    worker_levels = load_all_levels(level_filenames)
+    worker_notices = notices
+    # Keep the game's debug messages out of the report
+    sys.stdout = open(os.devnull, 'w')
+
+def verify_movie(filename):
+    from wbb import load_tas, load_trace
+    from simulation import run_movie, TraceChecker
+
+    frames = load_tas(filename)
+    tracefilename = os.path.splitext(filename)[0] + '.trace'
+    if os.path.exists(tracefilename):
+        # Check the trace while the movie plays rather than replaying it
+        checker = TraceChecker(load_trace(tracefilename))
+        frames = checker.count_frames(frames)
+    else:
+        checker = None
+    result = run_movie(frames, worker_levels, notices=worker_notices,
+                       observer=checker)
+    result['movie'] = os.path.basename(filename)
+    if checker:
+        result['desync'] = checker.result()
+    return result
+
+def format_result(result):
+    ballpos = result['ballpos']
+    ballpos = ("%.2f,%.2f" % tuple(ballpos)) if ballpos else '-'
+    line = ("%-24s %8d frames %3d doors %3d falls level %2d at %-16s %s"
+            % (result['movie'], result['frames'], result['doors'],
+               result['falls'], result['level_num'], ballpos,
+               (result['cells_hash'] or '-')[:16]))
+    if 'desync' not in result:
+        return line
+    desync = result['desync']
+    if not desync:
+        return line + " in sync"
+    return line + (" desync at movie frame %d (gameplay frame %d)"
+                   % (desync[1], desync[0]))
+
+def parse_argv(argv):
+    import argparse
+    import wbb
+
+    parser = argparse.ArgumentParser(
+        description="Play movies with no display and report how each ended."
+    )
+    parser.add_argument("moviedir",
+                        help="directory of movies in tasrec.txt format")
+    parser.add_argument("levels", nargs="*", default=wbb.level_filenames,
+                        help="level files in the order the game plays them")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of worker processes (default: one per CPU)")
+    parser.add_argument("-n", "--notices", type=int,
+                        default=0 if wbb.skipNotices else 3,
+                        help="number of notice screens each movie dismisses "
+                             "with A before the first level")
+    return parser.parse_args(argv[1:])
+
+def main(argv=None):
+    from multiprocessing import Pool
+
+    args = parse_argv(argv or sys.argv)
+    movies = sorted(os.path.join(args.moviedir, f)
+                    for f in os.listdir(args.moviedir)
+                    if f.endswith('.txt'))
+    if not movies:
+        print("movieverify.py: no movies in %s" % args.moviedir,
+              file=sys.stderr)
+        sys.exit(1)
+    pool = Pool(args.jobs, init_worker, (args.levels, args.notices))
+    try:
+        for result in pool.imap(verify_movie, movies):
+            print(format_result(result))
+    finally:
+        pool.close()
+        pool.join()
+
+if __name__=='__main__':
+    main()
@@ -1,11 +1,33 @@
 #!/usr/bin/env python
 from __future__ import division
+from struct import Struct
+from zlib import crc32
 import pygame as G
 try:
     xrange
 except NameError:
     xrange = range  # Python 3 workaround
 
+# win_x, cells_digest; followed by getcellbytes()
+plane_state = Struct('<iI')
+
+# Sizes of the playfield, as keyword arguments to MetatilePlane
+# Two 16x12 pages side by side, shared with the NES version
+NES_LAYOUT = {'width': 32, 'height': 12, 'page_width': 16}
+# Three pages, so that fast swings don't run past the loaded columns
+WIDE_LAYOUT = {'width': 48, 'height': 12, 'page_width': 16}
+
+def blitmany(dst, blits):
+    """Draw a list of (source, dest, area) to dst."""
+    if not blits:
+        return
+    try:
+        dst.blits(blits, False)
+    except AttributeError:
+        # Surface.blits() is new in pygame 1.9.4
+        for args in blits:
+            dst.blit(*args)
+
 class MetatilePlane(object):
     """
 
@@ -22,33 +44,90 @@ The order of operations:
 7. Convert this union to pixel coordinates.
 8. pygame.display.update() these coordinates.
 
+Tiles are drawn first to a nametable, a surface holding all columns
+of the ring as the NES would, and copied from there.  Only
+tiles changed with setcell() are drawn to the nametable, so redrawing
+the whole plane after scrolling costs one or two blits.
+
 """
-    def __init__(self, height=12, tw=16, th=16):
-        # Store cells as two 16x12 blocks because it's shared with NES
-        self.cells = [[[0] * 16 for y in xrange(height)] for pg in (0, 1)]
+    def __init__(self, height=12, tw=16, th=16, width=32, page_width=16):
+        """
+
+height -- number of rows
+tw, th -- size in pixels of each tile
+width -- number of columns in the ring of loaded columns
+page_width -- number of columns in each page of cells; width must
+be a multiple of this
+
+"""
+        if width % page_width:
+            raise ValueError("width %d is not a multiple of page width %d"
+                             % (width, page_width))
+        # Store cells as 16x12 blocks because it's shared with NES,
+        # one after the other in a flat bytearray
+        self.width, self.height, self.page_width = width, height, page_width
+        self.pagesize = page_width * height
+        self.cells = bytearray(width * height)
+        # CRC of every setcell() so far, for catching replay desyncs
+        self.cells_digest = 0
         self.sheet = None
+        self.all_dirty = (1 << width) - 1
         self.cleardirty(True)
         self.win_x = 0
         self.tw = tw
         self.th = th
-        
+        # Index into cells of each tile in dirty order
+        self.cellindex = [(x // page_width) * self.pagesize
+                          + y * page_width + x % page_width
+                          for y in xrange(height) for x in xrange(width)]
+        self.srcrects_sheet = self.srcrects = None
+        self.nametable_sheet = self.nametable = None
+        # Tiles changed since they were last drawn to the nametable
+        self.ntdirty = [self.all_dirty] * height
 
     def cleardirty(self, val):
         """Set dirty values of all tiles to True or False."""
-        val = bool(val)
-        # Store dirty as 32x12 because only Python needs it
-        self.dirty = [[val] * 32 for i in xrange(len(self.cells[0]))]
+        # Store dirty as width x height because only Python needs it,
+        # as one int per row with bit x set if column x is dirty
+        self.dirty = [self.all_dirty if val else 0] * self.height
 
     def getcell(self, x, y):
-        x = x % 32
-        tbl = self.cells[1 if x >= 16 else 0]
-        return tbl[y][x % 16]
+        if y < 0:
+            y += self.height
+        if not 0 <= y < self.height:
+            raise IndexError("row %d out of range" % y)
+        pw = self.page_width
+        x = x % self.width
+        return self.cells[x // pw * self.pagesize + y * pw + x % pw]
 
     def setcell(self, x, y, value):
-        x = x % 32
-        tbl = self.cells[1 if x >= 16 else 0]
-        tbl[y][x % 16] = value
-        self.dirty[y][x] = True
+        if y < 0:
+            y += self.height
+        if not 0 <= y < self.height:
+            raise IndexError("row %d out of range" % y)
+        pw = self.page_width
+        x = x % self.width
+        self.cells[x // pw * self.pagesize + y * pw + x % pw] = value
+        self.dirty[y] |= 1 << x
+        self.ntdirty[y] |= 1 << x
+        self.cells_digest = crc32(bytearray((x, y, value)), self.cells_digest)
+
+    def getcellbytes(self):
+        """Get all pages of cells as bytes, page by page and row by row."""
+        return bytes(self.cells)
+
+    def snapshot(self):
+        """Pack win_x and all pages of cells into bytes for restore()."""
+        return plane_state.pack(self.win_x, self.cells_digest) + self.getcellbytes()
+
+    def restore(self, data):
+        """Put back the result of snapshot() and mark everything dirty."""
+        if len(data) != plane_state.size + len(self.cells):
+            raise ValueError("snapshot is for a plane of a different size")
+        self.win_x, self.cells_digest = plane_state.unpack(data[:plane_state.size])
+        self.cells[:] = data[plane_state.size:]
+        self.ntdirty = [self.all_dirty] * self.height
+        self.cleardirty(True)
 
     def getrow(self, xmin, xmax, y):
         return [self.getcell(x, y) for x in xrange(xmin, xmax)]
@@ -69,52 +148,138 @@ The order of operations:
 Useful for scheduling a sprite to be erased in a dirty-rect environment.
 
 """
-        
-                      
         w += x % self.tw      # include entire tile that X is in
         w = -(-w // self.tw)  # round width up
-        x = (x // self.tw) % 32
-        if w >= 32:
-            x, w = 0, 32
+        x = (x // self.tw) % self.width
+        if w >= self.width:
+            x, w = 0, self.width
+        elif w <= 0:
+            return
         h += y % self.th      # include entire tile that Y is in
         h = -(-h // self.th)  # round height up
         y = y // self.th
         if y < 0:
             h -= y
             y = 0
-        if h > len(self.dirty) - y:
-            h = len(self.dirty) - y
-        leftw = max(0, x + w - 32)
-        w -= leftw
-        for row in self.dirty[y:y + h]:
-            if leftw:
-                row[:leftw] = [True] * leftw
-            row[x:x + w] = [True] * w
+        if h > self.height - y:
+            h = self.height - y
+        # Columns past the right side wrap around to the left
+        bits = (((1 << w) - 1) << x) | (((1 << w) - 1) << x >> self.width)
+        bits &= self.all_dirty
+        dirty = self.dirty
+        for yt in xrange(y, y + h):
+            dirty[yt] |= bits
 
     def setdirtyrects(self, rects, xscroll=0, yscroll=0):
         sdr = self.setdirtyrect
         for (x, y, w, h) in rects:
             sdr(x + xscroll, y + yscroll, w, h)
 
-    def redrawdirty(self, dst, xscroll=0, yscroll=0):
+    def getsrcrects(self):
+        """Get the source rectangle in self.sheet of each tile number."""
+        sheet = self.sheet
+        if self.srcrects_sheet is not sheet:
+            tw, th = self.tw, self.th
+            nperrow = sheet.get_width() // tw
+            self.srcrects = [G.rect.Rect(tileno % nperrow * tw,
+                                         tileno // nperrow * th, tw, th)
+                             for tileno in xrange(256)]
+            self.srcrects_sheet = sheet
+        return self.srcrects
+
+    def getnametable(self):
+        """Draw changed tiles to the nametable and return it."""
+        sheet = self.sheet
+        if self.nametable_sheet is not sheet:
+            size = (self.width * self.tw, self.height * self.th)
+            self.nametable = G.Surface(size, sheet.get_flags() & G.SRCALPHA,
+                                       sheet)
+            self.nametable_sheet = sheet
+            self.ntdirty = [self.all_dirty] * self.height
+        ntdirty = self.ntdirty
+        if not any(ntdirty):
+            return self.nametable
         tw, th = self.tw, self.th
-        nperrow = self.sheet.get_width() // tw
-        for (yt, row) in enumerate(self.dirty):
-            row_dsty = yt * th - yscroll
-            for (xt, d) in enumerate(row):
-                if not d:
-                    continue
-                tileno = self.cells[1 if xt >= 16 else 0][yt][xt % 16]
-                srcarea = G.rect.Rect(tileno % nperrow * tw,
-                                      tileno // nperrow * th,
-                                      tw, th)
-                dstpos = (((xt + 1) * tw - xscroll) % (32 * tw) - tw, row_dsty)
-                dst.blit(self.sheet, dstpos, srcarea)
+        srcrects = self.getsrcrects()
+        cells, cellindex = self.cells, self.cellindex
+        bitstoruns = self.bitstoruns
+        tiles = []
+        for (yt, bits) in enumerate(ntdirty):
+            dsty, rowstart = yt * th, yt * self.width
+            for (xt, w) in bitstoruns(bits):
+                tiles.extend((sheet, (x * tw, dsty),
+                              srcrects[cells[cellindex[rowstart + x]]])
+                             for x in xrange(xt, xt + w))
+        blitmany(self.nametable, tiles)
+        self.ntdirty = [0] * self.height
+        return self.nametable
+
+    def redrawdirty(self, dst, xscroll=0, yscroll=0):
+        """Draw all dirty tiles to dst and mark them clean.
+
+Return the runs of tiles that were drawn, as getdirtyruns() would
+have returned before drawing.
 
+"""
+        tw, th = self.tw, self.th
+        ringw = self.width * tw
+        nametable = self.getnametable()
         dirtied = self.getdirtyruns()
+        if self.dirty.count(self.all_dirty) == self.height:
+            # Everything is dirty, such as after scrolling
+            xscroll %= ringw
+            dst.blit(nametable, (-xscroll, -yscroll))
+            dst.blit(nametable, (ringw - xscroll, -yscroll))
+            self.cleardirty(False)
+            return dirtied
+
+        dstxs = [((xt + 1) * tw - xscroll) % ringw - tw
+                 for xt in xrange(self.width)]
+        R = G.rect.Rect
+        strips = []
+        for (yt, runs) in enumerate(dirtied):
+            srcy, dsty = yt * th, yt * th - yscroll
+            for (xt, w) in runs:
+                # Split the run where it wraps around the ring
+                end = xt + w
+                while xt < end:
+                    x = xt + 1
+                    while x < end and dstxs[x] > dstxs[xt]:
+                        x += 1
+                    strips.append((nametable, (dstxs[xt], dsty),
+                                   R(xt * tw, srcy, (x - xt) * tw, th)))
+                    xt = x
+        blitmany(dst, strips)
         self.cleardirty(False)
         return dirtied
 
+    @staticmethod
+    def bitstoruns(bits):
+        """Convert an int with bit x set for each dirty column to a list of
+(start, length) tuples.
+
+"""
+        runs = []
+        x = 0
+        while bits:
+            skip = (bits & -bits).bit_length() - 1
+            bits >>= skip
+            x += skip
+            # bits + 1 carries through the run, leaving one bit set past it
+            w = ((bits + 1) & ~bits).bit_length() - 1
+            runs.append((x, w))
+            bits >>= w
+            x += w
+        return runs
+
+    @staticmethod
+    def runstobits(runs):
+        """Convert a list of (start, length) tuples to an int."""
+        bits = 0
+        for (x, w) in runs:
+            bits |= ((1 << w) - 1) << x
+        return bits
+
     @staticmethod
     def boolstoruns(row):
         """Convert an iterable of booleans to an iterator of (start, length) tuples."""
@@ -137,8 +302,8 @@ Useful for scheduling a sprite to be erased in a dirty-rect environment.
 Return a list of lists of (start, length) tuples.
 
 """
-        # TO DO: test
-        return [list(self.boolstoruns(row)) for row in self.dirty]
+        bitstoruns = self.bitstoruns
+        return [bitstoruns(bits) for bits in self.dirty]
 
     @staticmethod
     def unionruns(*seqs):
@@ -178,6 +343,8 @@ Good for combining the last frame's sprite-covered dirty tiles
 
     @staticmethod
     def unionoldnewdirty(old, new):
-        ur = MetatilePlane.unionruns
-        return [list(ur(a, b)) for (a, b) in zip(old, new)]
+        bitstoruns = MetatilePlane.bitstoruns
+        runstobits = MetatilePlane.runstobits
+        return [bitstoruns(runstobits(a) | runstobits(b))
+                for (a, b) in zip(old, new)]
     
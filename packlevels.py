@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Put levels into one level pack file
+
+usage: packlevels.py OUT.wbbp [LEVEL.map ...]
+
+Each level is named after its file name without the extension, and
+levels are packed in the order given.  Set wbb.level_pack_filename
+to play a pack.
+
+"""
+from __future__ import with_statement, division, print_function, unicode_literals
+import os
+import sys
+
+def main(argv=None):
+    import argparse
+    import wbb
+    from levels import write_level_pack
+
+    parser = argparse.ArgumentParser(
+        description="Put .map levels into a .wbbp level pack."
+    )
+    parser.add_argument("output", help="level pack to write")
+    parser.add_argument("levels", nargs="*", default=wbb.level_filenames,
+                        help="level files in the order the game plays them")
+    args = parser.parse_args((argv or sys.argv)[1:])
+    named_levels = []
+    for filename in args.levels:
+        with open(filename, 'rb') as infp:
+            named_levels.append((os.path.splitext(os.path.basename(filename))[0],
+                                 infp.read()))
+    write_level_pack(args.output, named_levels)
+
+if __name__=='__main__':
+    main()
@@ -2,8 +2,9 @@
 from __future__ import with_statement, division, print_function, unicode_literals
 import pygame as G
 from math import floor
+from struct import Struct
 from wbbmath import clip_vel_to_cable, get_rtheta, TAU, sintable, costable, angleunit
-from wbbmath import plus_gravity
+from wbbmath import plus_gravity, float_mask, unmask_floats
 from rope import draw_rope, Rope
 from levels import solidTiles, downSolidTiles
 import chipsfx
@@ -53,9 +54,28 @@ class TumblingBlock(object):
         self.direction = direction
         self.progress = 0
 
+    # x, y, progress; float mask, direction (255 for None)
+    state_struct = Struct('<3dBB')
+
     def done(self):
         return self.direction is None
 
+    def snapshot(self):
+        """Pack the block's state into bytes for restore()."""
+        values = [self.x, self.y, self.progress]
+        direction = 255 if self.direction is None else self.direction
+        return self.state_struct.pack(*(values + [float_mask(values), direction]))
+
+    @classmethod
+    def restore(cls, data, pf):
+        """Make a block in pf from the result of snapshot()."""
+        values = cls.state_struct.unpack(data)
+        x, y, progress = unmask_floats(values[3], values[:3])
+        self = cls(x, y, None if values[4] == 255 else values[4])
+        self.progress = progress
+        self.pf = pf
+        return self
+
     def move(self):
         if self.direction in (self.DIR_RIGHT, self.DIR_LEFT):
             self.progress += 5
@@ -68,8 +88,10 @@ class TumblingBlock(object):
             self.progress = min(plus_gravity(self.progress), 8)
             self.y += self.progress
             yt = int(self.y // 16)
-            tbelow = self.pf.getcell(self.x // 16, yt + 1) if yt < 11 else 0
-            if yt >= 12:
+            rows = self.pf.height
+            tbelow = (self.pf.getcell(self.x // 16, yt + 1)
+                      if yt < rows - 1 else 0)
+            if yt >= rows:
                 self.direction = None
             elif tbelow in solidTiles or tbelow in downSolidTiles:
                 chipsfx.fxq('land')
@@ -135,7 +157,8 @@ def four_corner_collide(pf, x, y, r, with_downsolid=True):
     # 4 8
     coords = enumerate((tlx + x1, tly + y1)
                        for y1 in (0, 1) for x1 in (0, 1))
-    blks = [(i, pf.getcell(x1, min(y1, 11)) if 0 <= x1 and 0 <= y1 else 0)
+    blks = [(i, pf.getcell(x1, min(y1, pf.height - 1))
+                if 0 <= x1 and 0 <= y1 else 0)
             for (i, (x1, y1)) in coords]
     blks = sum(1 << i
                if (t in solidTiles
@@ -239,6 +262,11 @@ class Player(object):
     OUTSTRETCHED_LEN = 20  # length of outstretched arm
     INCLUDED_LEN = 12  # length of rope included in ballpos
 
+    # ballpos, ballvel, theta, armangle, walking_frame; float mask,
+    # state, facing_left, has_rope, downsolid_y; followed by
+    # Rope.snapshot() if there is a rope
+    state_struct = Struct('<7dBBBBh')
+
     def __init__(self):
         self.ballpos = [40, 170]
         self.ballvel = [0, 0]
@@ -253,6 +281,32 @@ class Player(object):
 ##        self.ballpos = [128, 64]
 ##        self.state = self.ST_FALLING_ROT_TEST
 
+    def snapshot(self):
+        """Pack the player's and rope's state into bytes for restore()."""
+        values = [self.ballpos[0], self.ballpos[1],
+                  self.ballvel[0], self.ballvel[1],
+                  self.theta, self.armangle, self.walking_frame]
+        data = self.state_struct.pack(*(values + [
+            float_mask(values), self.state, bool(self.facing_left),
+            bool(self.has_rope), self.downsolid_y
+        ]))
+        return data + self.rope.snapshot() if self.rope else data
+
+    def restore(self, data):
+        """Put back the result of snapshot().  Requires self.pf."""
+        sz = self.state_struct.size
+        values = self.state_struct.unpack(data[:sz])
+        (b0, b1, v0, v1, self.theta, self.armangle, self.walking_frame
+         ) = unmask_floats(values[7], values[:7])
+        self.ballpos = [b0, b1]
+        self.ballvel = [v0, v1]
+        self.state = values[8]
+        self.facing_left = bool(values[9])
+        self.has_rope = bool(values[10])
+        self.downsolid_y = values[11]
+        self.rope = (Rope.restore(data[sz:], self.pf.getcell, self.pf.height)
+                     if len(data) > sz else None)
+
     def get_hanging_hotspot_chain(self):
         # 0: facing up; TAU/2: facing forward; TAU: facing down
         theta = ((TAU * 3 // 2) - self.theta if self.facing_left else self.theta) % TAU
@@ -445,7 +499,7 @@ buttpos -- (x, y) position of hammer in pixels
             if vkeys & VK_DOWN:
                 xt = int(buttpos[0] // 16)
                 yt = int(buttpos[1] // 16) + 1
-                is_downsolid = (0 <= yt < 12 and 0 <= xt
+                is_downsolid = (0 <= yt < self.pf.height and 0 <= xt
                                 and self.pf.getcell(xt, yt) in downSolidTiles)
                 if is_downsolid:
                     # Down while anchored and resting on down-solid
@@ -492,7 +546,7 @@ buttpos -- (x, y) position of hammer in pixels
                 dtheta = (TAU // 4 - self.theta)
                 self.theta += dtheta // 2
 
-        if (0 < self.ballpos[1] < 192
+        if (0 < self.ballpos[1] < self.pf.height * 16
             and (vkeys & (VK_UP | VK_DOWN))):
             tox = int(self.ballpos[0] // 16)
             toy = int(self.ballpos[1] // 16)
@@ -526,9 +580,9 @@ buttpos -- (x, y) position of hammer in pixels
             self.facing_left = not self.facing_left
 
     def spawn_tumbling_block(self, xcell, ycell, to_left):
-        from levels import markov
+        from levels import markov_table
 
-        if not (0 <= xcell and 0 <= ycell < 12):
+        if not (0 <= xcell and 0 <= ycell < self.pf.height):
             print("no tumble if out of bounds")
             return False
         tilehere = self.pf.getcell(xcell, ycell)
@@ -549,7 +603,7 @@ buttpos -- (x, y) position of hammer in pixels
             print("no tumble if destination blocked")
             return False
         tile_fabove = self.pf.getcell(xdst, ycell - 1) if xdst >= 0 and ycell > 0 else 0
-        tile_pred = markov[tile_fabove] if tile_fabove < len(markov) else 0
+        tile_pred = markov_table[tile_fabove]
         if tile_dst != tile_pred:
             print("no tumble if prediction mismatch: %d != expected %d below %d"
                   % (tile_dst, tile_pred, tile_fabove))
@@ -558,7 +612,7 @@ buttpos -- (x, y) position of hammer in pixels
         tumble_dir = TumblingBlock.DIR_LEFT if to_left else TumblingBlock.DIR_RIGHT
         t = TumblingBlock(xcell * 16, ycell * 16, tumble_dir)
         t.pf = self.pf
-        self.pf.setcell(xcell, ycell, markov[tile_above] if tile_above < len(markov) else 0)
+        self.pf.setcell(xcell, ycell, markov_table[tile_above])
         self.pf.tumble.append(t)
         return True
 
@@ -592,7 +646,8 @@ buttpos -- (x, y) position of hammer in pixels
                    self.ballvel[1]
                    + (amt if vk_ud & VK_DOWN else -amt if vk_ud else 0)]
             pos = [self.ballpos[0], self.ballpos[1]]
-        self.rope = Rope(self.MAX_CABLELEN, pos, self.pf.getcell, vel)
+        self.rope = Rope(self.MAX_CABLELEN, pos, self.pf.getcell, vel,
+                         self.pf.height)
         chipsfx.fxq('launch')
 
     def pushing_neighborhood(self):
@@ -663,7 +718,7 @@ buttpos -- (x, y) position of hammer in pixels
                 return
             # Don't pull block if no solid ground behind player
             below_dest_tile = (self.pf.getcell(xt - fwd, yt + 1)
-                               if yt < 11 and xt - fwd >= 0
+                               if yt < self.pf.height - 1 and xt - fwd >= 0
                                else 0)
             below_dest_solid = (below_dest_tile in solidTiles
                                 or below_dest_tile in downSolidTiles)
@@ -754,7 +809,7 @@ buttpos -- (x, y) position of hammer in pixels
         fromy = int(butty // 16)
         tox = int(self.rope.pos[0] // 16)
         toy = int(self.rope.pos[1] // 16)
-        if not (0 <= tox and 0 <= toy < 12):
+        if not (0 <= tox and 0 <= toy < self.pf.height):
             print("climb: coords out of bounds")
             return False
         totile = self.pf.getcell(tox, toy)
@@ -771,7 +826,7 @@ buttpos -- (x, y) position of hammer in pixels
             ropepos = [c // 8 * 8 + 2 for c in ropepos]
             self.ballpos = [ropepos[0] + costable[self.theta] * self.INCLUDED_LEN,
                             ropepos[1] + sintable[self.theta] * self.INCLUDED_LEN]
-            self.rope = Rope(0, ropepos, self.pf.getcell)
+            self.rope = Rope(0, ropepos, self.pf.getcell, rows=self.pf.height)
             self.rope.vel = None
             self.state = self.ST_ON_SWINGBAR
             return False
@@ -801,7 +856,7 @@ buttpos -- (x, y) position of hammer in pixels
         coords.extend((x, toy - 1) for x in range(fromx, tox + dx, dx))
         if any(self.pf.getcell(x, y) in solidTiles
                for (x, y) in coords
-               if 0 <= x and 0 <= y < 12):
+               if 0 <= x and 0 <= y < self.pf.height):
             print("climb: tiles in way")
             return False
         self.rope = None
@@ -871,7 +926,7 @@ buttpos -- (x, y) position of hammer in pixels
                 yt = int((self.ballpos[1] - 16) // 16)
                 tile_u = getcell(xt, yt) if yt >= 0 else 0
                 tile_fu = getcell(xt + fwd, yt) if yt >= 0 else 0
-                tile_f = getcell(xt + fwd, min(11, yt + 1))
+                tile_f = getcell(xt + fwd, min(self.pf.height - 1, yt + 1))
                 if tile_u in (6, 7):
                     self.ballvel = [0, -3/16]
                 elif (tile_u not in solidTiles and tile_fu not in solidTiles
@@ -880,7 +935,7 @@ buttpos -- (x, y) position of hammer in pixels
                     return
             elif vkeys & VK_DOWN:
                 yt = int((self.ballpos[1] + 8) // 16)
-                tile_d = getcell(xt, yt) if yt < 12 else 0
+                tile_d = getcell(xt, yt) if yt < self.pf.height else 0
                 if tile_d in (6, 7):
                     self.ballvel = [0, 3/16]
                 elif tile_d in solidTiles or tile_d in downSolidTiles:
@@ -1039,7 +1094,8 @@ buttpos -- (x, y) position of hammer in pixels
         colltl = (int(floor(self.ballpos[0])) - 4, int(floor(self.ballpos[1])) - 11)
         collbr = (colltl[0] + 8, colltl[1] + 16)
 
-        if 0 <= colltl[1] < 192:
+        pfbottom = self.pf.height * 16
+        if 0 <= colltl[1] < pfbottom:
             lwalltile = getcell(colltl[0] // 16, colltl[1] >> 4)
             rwalltile = getcell(collbr[0] // 16, colltl[1] // 16)
         else:
@@ -1055,7 +1111,7 @@ buttpos -- (x, y) position of hammer in pixels
         floor_x = [0, 0, 0, 3, 0, -3, 0][min(self.walking_frame // 256, 5)]
         eff_x = (collbr[0] + colltl[0]) // 2 + floor_x * fwd
         floortile = (getcell(eff_x // 16, collbr[1] >> 4)
-                     if 0 <= eff_x and 0 <= collbr[1] < 192
+                     if 0 <= eff_x and 0 <= collbr[1] < pfbottom
                      else 0)
         if rwalltile in solidTiles:
             ejectAmt = max(1, self.ballvel[0])
@@ -1088,10 +1144,10 @@ buttpos -- (x, y) position of hammer in pixels
                 self.get_onto_ladder()
             
             lsolid = (getcell(colltl[0] // 16, collbr[1] >> 4) in solidTiles
-                      if 0 <= collbr[1] < 192
+                      if 0 <= collbr[1] < pfbottom
                       else False)
             rsolid = (getcell(collbr[0] // 16, collbr[1] >> 4) in solidTiles
-                      if 0 <= collbr[1] < 192
+                      if 0 <= collbr[1] < pfbottom
                       else False)
             # Push to side
             if lsolid:
@@ -1147,12 +1203,23 @@ buttpos -- (x, y) position of hammer in pixels
                 else:
                     self.ballpos[0] += 1
 
-    def draw_walking(self, screen, camx=0):
+    def wrap_walking_frame(self):
+        """Wrap walking_frame around the walking cycle.
+
+Call once per frame after move().  This used to happen in
+draw_walking(), which kept the game rules from running without
+drawing.
+
+"""
+        if self.state not in (self.ST_WALKING, self.ST_PREPULLING):
+            return
         if self.walking_frame >= 7 * 256:
             self.walking_frame -= 7 * 256
         elif self.walking_frame < 0:
             chipsfx.fxq('steplift')
             self.walking_frame += 5 * 256
+
+    def draw_walking(self, screen, camx=0):
         f = self.walking_frame >> 8
         if f == 0 and self.ballvel[0] == 0:
             f = 8
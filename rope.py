@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 from __future__ import division, print_function, unicode_literals
+from struct import Struct
 import pygame as G
 from wbbmath import get_rtheta, clip_vel_to_cable, TAU, angleunit
-from wbbmath import plus_gravity, nmis
+from wbbmath import plus_gravity, nmis, float_mask, unmask_floats
 from levels import solidTiles, downSolidTiles, noGrappleTiles
 import chipsfx
 
@@ -112,17 +113,44 @@ Each step is taken based on the first rule that applies:
 class Rope(object):
     MIN_CABLELEN = 0
 
-    def __init__(self, maxlen, pos, getcell, vel=None):
+    # pos, vel, length, maxlen; float mask, flags, wrapkey
+    # flags: 0x01 vel is not None, 0x02 length is not None
+    state_struct = Struct('<6dBBB')
+
+    def __init__(self, maxlen, pos, getcell, vel=None, rows=12):
         self.length = self.maxlen = maxlen
         self.pos = list(pos)
         self.vel = vel or [0, 0]
         self.getcell = getcell
+        self.rows = rows  # height of the playfield in tiles
 
         # wrapkey is created from bits 5 and 4 of the horizontal and
         # vertical position of both ends of the rope.
         # Rope wrap testing is skipped when it doesn't change.
         self.wrapkey = self.get_wrapkey(pos)
 
+    def snapshot(self):
+        """Pack the rope's state into bytes for restore()."""
+        vel = self.vel or (0, 0)
+        values = [self.pos[0], self.pos[1], vel[0], vel[1],
+                  self.length or 0, self.maxlen]
+        flags = (0x01 if self.vel else 0) | (0x02 if self.length is not None else 0)
+        return self.state_struct.pack(*(values + [float_mask(values), flags,
+                                                  self.wrapkey]))
+
+    @classmethod
+    def restore(cls, data, getcell, rows=12):
+        """Make a rope from the result of snapshot()."""
+        values = cls.state_struct.unpack(data)
+        pos0, pos1, vel0, vel1, length, maxlen = unmask_floats(values[6],
+                                                               values[:6])
+        flags = values[7]
+        self = cls(maxlen, (pos0, pos1), getcell, rows=rows)
+        self.vel = [vel0, vel1] if flags & 0x01 else None
+        self.length = length if flags & 0x02 else None
+        self.wrapkey = values[8]
+        return self
+
     def get_wrapkey(self, ballpos):
         return ((int(ballpos[0] // 16) & 0x03) << 6
                 | (int(ballpos[1] // 16) & 0x03) << 4
@@ -142,7 +170,8 @@ class Rope(object):
             # if hit top of play area
             self.pos[0] = 0
             self.vel[0] = 0
-        if self.pos[1] >= 192 and self.vel[1] > 0:
+        rows = self.rows
+        if self.pos[1] >= rows * 16 and self.vel[1] > 0:
             # if falling below
             self.pos = self.vel = self.length = None
             return
@@ -153,7 +182,7 @@ class Rope(object):
         balltile = (int(ballpos[0] // 16), int(ballpos[1] // 16))
         wraptest_near = 1 if self.pos[0] > ballpos[0] else 15
         t = (0 if halftiley < 0
-             else 1 if halftiley >= 24
+             else 1 if halftiley >= rows * 2
              else self.getcell(*anchortile))
 
         # hack to wrap around #5 (pole top) if anchor is to the right
@@ -181,13 +210,13 @@ class Rope(object):
             self.length = max(self.MIN_CABLELEN, r)
 
             # if hit top of near block, latch to the near corner
-            upsolid = (0 <= anchortile[1] < 12
+            upsolid = (0 <= anchortile[1] < rows
                        and self.getcell(anchortile[0], anchortile[1] - 1)
                            in solidTiles)
             facing_left = self.pos[0] < ballpos[0]
             nearsolidx = anchortile[0] + (1 if facing_left else -1)
             neartile = (self.getcell(nearsolidx, anchortile[1])
-                        if 0 < anchortile[1] < 12 and 0 <= nearsolidx
+                        if 0 < anchortile[1] < rows and 0 <= nearsolidx
                         else 0)
             nearsolid = neartile in solidTiles
             if (t in solidTiles and self.pos[1] % 16 < 3
@@ -200,7 +229,8 @@ class Rope(object):
         if self.vel and wrapkey != self.wrapkey:
             self.wrapkey = wrapkey
             coords = [(x, y,
-                       self.getcell(x, y) if 0 <= x and 0 <= y < 12 else None)
+                       self.getcell(x, y) if 0 <= x and 0 <= y < rows
+                       else None)
                       for (x, y)
                       in wraptest_trace(balltile[0], balltile[1],
                                         anchortile[0], anchortile[1])]
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Seekable binary movie format
+
+usage: seekmovie.py [-n NOTICES] [-k INTERVAL] MOVIE.txt OUT.wbbm [LEVEL.map ...]
+
+A .wbbm file holds the same frames as a movie in tasrec.txt format,
+plus a MoviePlayer.snapshot() every few hundred frames of gameplay,
+so that review tools can jump to any frame by restoring the keyframe
+before it and running at most one keyframe interval of frames.
+
+File layout (all numbers little-endian):
+header -- magic 'WBBM', version, notice count, keyframe interval,
+number of frames, frame where gameplay starts, number of keyframes
+vkeys -- one 16-bit word per frame, including notice screens
+keyframe index -- frame number, file offset and length of each
+keyframe, in increasing frame order
+keyframes -- MoviePlayer.snapshot() taken before running that frame
+
+"""
+from __future__ import with_statement, division, print_function, unicode_literals
+from struct import Struct
+from array import array
+import sys
+
+MAGIC = b'WBBM'
+VERSION = 1
+header_struct = Struct('<4sHHIIII')
+index_struct = Struct('<III')
+
+def vkeys_to_bytes(frames):
+    frames = array('H', frames)
+    if sys.byteorder != 'little':
+        frames.byteswap()
+    return frames.tobytes()
+
+def write_seekable_movie(filename, frames, all_levels, notices=0,
+                         keyframe_interval=600):
+    """Play a movie with no display and save it with keyframes.
+
+frames -- sequence of vkeys, one per frame
+all_levels -- list of level data structures, as for run_movie()
+notices -- number of notice screens at the start of the movie
+
+"""
+    from simulation import MoviePlayer, skip_notices
+    import wbbmath, chipsfx
+
+    frames = array('H', list(frames))
+    wbbmath.nmis = 0
+    del chipsfx.queued_fx[:]
+    notice_frames = skip_notices(iter(frames), notices)
+    if notice_frames is None:
+        gameplay_start, last_vkeys = len(frames), ~0
+    else:
+        gameplay_start, last_vkeys = notice_frames
+
+    keyframes = []
+    player = MoviePlayer(all_levels, 0, last_vkeys)
+    for i in range(gameplay_start, len(frames)):
+        if (i - gameplay_start) % keyframe_interval == 0:
+            keyframes.append((i, player.snapshot()))
+        if player.step(frames[i]):
+            break
+
+    vkeysdata = vkeys_to_bytes(frames)
+    offset = (header_struct.size + len(vkeysdata)
+              + index_struct.size * len(keyframes))
+    index = []
+    for (frame, data) in keyframes:
+        index.append(index_struct.pack(frame, offset, len(data)))
+        offset += len(data)
+    with open(filename, 'wb') as outfp:
+        outfp.write(header_struct.pack(MAGIC, VERSION, notices,
+                                       keyframe_interval, len(frames),
+                                       gameplay_start, len(keyframes)))
+        outfp.write(vkeysdata)
+        outfp.writelines(index)
+        outfp.writelines(data for (frame, data) in keyframes)
+
+class SeekableMovie(object):
+    """Random access to a movie saved by write_seekable_movie().
+
+Only the header and keyframe index are read up front.  Frames and
+keyframes are read from the file as needed.
+
+"""
+    def __init__(self, filename):
+        self.fp = open(filename, 'rb')
+        (magic, version, self.notices, self.keyframe_interval,
+         self.num_frames, self.gameplay_start, num_keyframes
+         ) = header_struct.unpack(self.fp.read(header_struct.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s: not a version %d seekable movie"
+                             % (filename, VERSION))
+        self.fp.seek(header_struct.size + 2 * self.num_frames)
+        indexdata = self.fp.read(index_struct.size * num_keyframes)
+        self.keyframes = [index_struct.unpack_from(indexdata, i)
+                          for i in range(0, len(indexdata), index_struct.size)]
+        self.keyframe_starts = [row[0] for row in self.keyframes]
+
+    def close(self):
+        self.fp.close()
+
+    def read_vkeys(self, start, stop):
+        """Get an array of the vkeys of frames start through stop - 1."""
+        start = max(0, min(start, self.num_frames))
+        stop = max(start, min(stop, self.num_frames))
+        self.fp.seek(header_struct.size + 2 * start)
+        frames = array('H')
+        frames.frombytes(self.fp.read(2 * (stop - start)))
+        if sys.byteorder != 'little':
+            frames.byteswap()
+        return frames
+
+    def __iter__(self):
+        """Iterate over all vkeys, like load_tas()."""
+        for start in range(0, self.num_frames, 4096):
+            for vkeys in self.read_vkeys(start, start + 4096):
+                yield vkeys
+
+    def seek(self, frame, all_levels, player=None):
+        """Get a MoviePlayer in the state just before frame is run.
+
+Frames before gameplay starts go to the start of gameplay.
+player -- a MoviePlayer from an earlier seek() to reuse, which
+saves reloading the level if it hasn't changed
+
+"""
+        from bisect import bisect_right
+        from simulation import MoviePlayer
+
+        if not self.keyframes:
+            raise ValueError("movie has no gameplay")
+        frame = max(self.gameplay_start, min(frame, self.num_frames))
+        i = max(0, bisect_right(self.keyframe_starts, frame) - 1)
+        start, offset, length = self.keyframes[i]
+        self.fp.seek(offset)
+        data = self.fp.read(length)
+        if player is None:
+            player = MoviePlayer(all_levels)
+        player.restore(data)
+        for vkeys in self.read_vkeys(start, frame):
+            if player.step(vkeys):
+                break
+        return player
+
+def main(argv=None):
+    import argparse
+    import wbb
+    from levels import load_all_levels
+
+    parser = argparse.ArgumentParser(
+        description="Convert a movie in tasrec.txt format to a seekable .wbbm file."
+    )
+    parser.add_argument("movie", help="movie in tasrec.txt format")
+    parser.add_argument("output", help="seekable movie to write")
+    parser.add_argument("levels", nargs="*", default=wbb.level_filenames,
+                        help="level files in the order the game plays them")
+    parser.add_argument("-n", "--notices", type=int,
+                        default=0 if wbb.skipNotices else 3,
+                        help="number of notice screens the movie dismisses "
+                             "with A before the first level")
+    parser.add_argument("-k", "--keyframe-interval", type=int, default=600,
+                        help="frames of gameplay between keyframes")
+    args = parser.parse_args((argv or sys.argv)[1:])
+    all_levels = load_all_levels(args.levels)
+    write_seekable_movie(args.output, wbb.load_tas(args.movie), all_levels,
+                         args.notices, args.keyframe_interval)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+from __future__ import division, print_function, unicode_literals
+from struct import pack, Struct
+from zlib import crc32
+from mtplane import MetatilePlane, NES_LAYOUT
+from player import Player
+from levels import load_level, load_level_col
+import wbbmath
+import chipsfx
+
+# Pseudo-button returned once a movie runs out of frames
+VK_EOM = 0x100
+
+first_level_help = "\x1b\x1a\x19\x18:move  A:push  \x19A: pull"
+
+outcome_codes = [None, 'eom', 'door', 'fell']
+soln_codes = [None, '1. Pino', '2. Nova', '3. Snowy']
+
+# camx, num_frames, last_vkeys, outcome, soln, nmis; lengths of
+# pf, player, tumbling blocks and queued_fx parts that follow
+sim_state = Struct('<iIiBBBHHHH')
+
+class Simulation(object):
+    """One attempt at one level, with no display or clock.
+
+Each call to step() runs one 60 Hz frame of game rules.  Anything
+that needs to see the frame, such as a renderer or the sound effect
+player, goes in observers: callables that get the Simulation after
+the frame's game rules and before the NMI counter advances.
+
+outcome is None while the level is in progress, or one of these:
+'eom' -- the movie ran out of frames
+'door' -- the player finished entering a door
+'fell' -- the player fell below the playfield
+
+"""
+    def __init__(self, level, is_first_level=False, last_vkeys=~0,
+                 layout=None):
+        """
+
+level -- level data structure from levels.decode_level()
+is_first_level -- True to show the tutorial help and look for
+which solution the player used
+last_vkeys -- keys held on the previous frame, so that keys already
+held when the level starts don't count as pressed
+layout -- dict of MetatilePlane arguments for the playfield size,
+by default mtplane.NES_LAYOUT
+
+"""
+        self.level = level
+        self.is_first_level = is_first_level
+        self.last_vkeys = last_vkeys
+        self.pf = pf = MetatilePlane(**(layout or NES_LAYOUT))
+        load_level(pf, level)
+        pf.tumble = []
+        pf.win_x = 0
+        self.p = p = Player()
+        startpos = level['start']
+        p.ballpos = [startpos[0] * 16 + 8, startpos[1] * 16 + 11]
+        p.pf = pf
+        self.camx = 0
+        self.soln = None
+        self.helptxt = first_level_help if is_first_level else ""
+        self.outcome = None
+        self.num_frames = 0
+        self.observers = []
+
+    def step(self, vkeys, new_vkeys=None):
+        """Run one frame of game rules.
+
+vkeys -- buttons held this frame, in NES order (see player.VK_*)
+new_vkeys -- buttons pressed this frame, or None to compute it from
+the previous frame's vkeys
+
+Return True if the level has ended, with the reason in outcome.
+
+"""
+        if new_vkeys is None:
+            new_vkeys = vkeys & ~self.last_vkeys
+        self.last_vkeys = vkeys
+        p, pf = self.p, self.pf
+        if new_vkeys & VK_EOM:
+            self.outcome = 'eom'
+        p.move(vkeys, new_vkeys)
+        p.ballpos[0] = max(pf.win_x * 16 + 4, p.ballpos[0])
+        if p.state == p.ST_ENTERING_DOOR and p.walking_frame >= 1024:
+            self.outcome = 'door'
+        # if below pfdst and not hanging, fail
+        if (p.ballpos[1] >= pf.height * 16 + 16
+            and (not p.rope or p.rope.vel)):
+            self.outcome = 'fell'
+
+        pf.tumble = [t for t in pf.tumble if t and not t.done()]
+        for t in pf.tumble:
+            t.move()
+
+        if (not self.soln and p.ballpos[0] >= 192+512
+            and self.is_first_level):
+            if not pf.getcell(14+32, 9):
+                self.soln = '2. Nova'
+            elif pf.getcell(13+32, 10):
+                self.soln = '1. Pino'
+            elif p.state == p.ST_CLIMBING and p.ballpos[0] >= 216+512:
+                self.soln = "3. Snowy"
+            if self.soln:
+                self.helptxt = self.soln
+
+        self.scroll()
+        p.wrap_walking_frame()
+
+        for observer in self.observers:
+            observer(self)
+        del chipsfx.queued_fx[:]
+        wbbmath.inc_nmis()
+        self.num_frames += 1
+        return self.outcome is not None
+
+    def snapshot(self):
+        """Pack the whole game state into bytes for restore().
+
+This includes the module globals wbbmath.nmis and chipsfx.queued_fx.
+
+"""
+        pfdata = self.pf.snapshot()
+        pdata = self.p.snapshot()
+        tumbledata = b''.join(t.snapshot() for t in self.pf.tumble)
+        fxdata = ','.join(chipsfx.queued_fx).encode('utf-8')
+        return b''.join((
+            sim_state.pack(self.camx, self.num_frames, self.last_vkeys,
+                           outcome_codes.index(self.outcome),
+                           soln_codes.index(self.soln), wbbmath.nmis,
+                           len(pfdata), len(pdata), len(tumbledata),
+                           len(fxdata)),
+            pfdata, pdata, tumbledata, fxdata
+        ))
+
+    def restore(self, data):
+        """Put back the result of snapshot() from a Simulation of the same level."""
+        from player import TumblingBlock
+
+        (self.camx, self.num_frames, self.last_vkeys, outcome, soln,
+         wbbmath.nmis, pflen, plen, tumblelen, fxlen
+         ) = sim_state.unpack(data[:sim_state.size])
+        self.outcome = outcome_codes[outcome]
+        self.soln = soln_codes[soln]
+        if self.soln:
+            self.helptxt = self.soln
+        else:
+            self.helptxt = first_level_help if self.is_first_level else ""
+        pf = self.pf
+        start = sim_state.size
+        pf.restore(data[start:start + pflen])
+        start += pflen
+        self.p.restore(data[start:start + plen])
+        start += plen
+        tsz = TumblingBlock.state_struct.size
+        pf.tumble = [TumblingBlock.restore(data[i:i + tsz], pf)
+                     for i in range(start, start + tumblelen, tsz)]
+        start += tumblelen
+        fxdata = data[start:start + fxlen].decode('utf-8')
+        chipsfx.queued_fx[:] = fxdata.split(',') if fxdata else []
+
+    def state_hash(self):
+        """Get a 32-bit CRC of the state that shows a replay desync.
+
+It covers the player's position, velocity, state and pose, the rope,
+the NMI counter, and pf.cells_digest.
+
+"""
+        p = self.p
+        vals = [p.ballpos[0], p.ballpos[1], p.ballvel[0], p.ballvel[1],
+                p.theta, p.armangle, p.walking_frame]
+        rope = p.rope
+        if rope:
+            vals.extend(rope.pos or (-1, -1))
+            vals.extend(rope.vel or (0, 0))
+            vals.append(rope.length or 0)
+            vals.append(rope.wrapkey)
+        data = pack('<3B%dd' % len(vals),
+                    p.state, wbbmath.nmis, 1 if rope else 0, *vals)
+        return crc32(data, self.pf.cells_digest) & 0xFFFFFFFF
+
+    def scroll(self):
+        """Move the camera toward the player and load columns that come into view."""
+        p, pf = self.p, self.pf
+        camtarget = p.ballpos[0] + (-16 if p.facing_left else 16)
+        if p.rope and p.rope.pos and p.state == p.ST_FALLING:
+            camtarget = (camtarget + p.rope.pos[0]) / 2
+        camx = max(int(camtarget) - 128, pf.win_x * 16)
+        camdelta = abs(camx - self.camx) // 16 + 1
+        camx = min(self.camx + camdelta, max(self.camx - camdelta, camx))
+        if camx != self.camx:
+            wanted_winx = camx // 16
+            # Keep 15 columns behind the camera and the rest of the
+            # ring ahead of it
+            if wanted_winx >= pf.win_x + 15:
+                pf.win_x += 1
+                load_level_col(pf, self.level, pf.win_x + pf.width - 1)
+            self.camx = camx
+
+class MoviePlayer(object):
+    """Gameplay of a movie across levels, the way wbb.main() plays it.
+
+Entering a door goes to the next level in all_levels, and falling
+restarts the current one.  sim is the Simulation of the current
+attempt at the current level.
+
+"""
+
+    # level_num, num_frames, doors, falls; followed by Simulation.snapshot()
+    state_struct = Struct('<HIII')
+
+    def __init__(self, all_levels, level_num=0, last_vkeys=~0, observers=(),
+                 layout=None):
+        """
+
+all_levels -- list of level data structures
+level_num -- index into all_levels of the level to start on
+last_vkeys -- keys held on the frame before the first
+observers -- added to each Simulation's observers
+layout -- playfield size passed to each Simulation
+
+"""
+        self.all_levels = all_levels
+        self.level_num = level_num
+        self.observers = list(observers)
+        self.layout = layout
+        self.num_frames = self.doors = self.falls = 0
+        self.ended = False
+        self.start_level(last_vkeys)
+
+    def start_level(self, last_vkeys):
+        level = self.all_levels[self.level_num]
+        self.sim = Simulation(level, self.level_num == 0, last_vkeys,
+                              self.layout)
+        self.sim.observers.extend(self.observers)
+
+    def step(self, vkeys):
+        """Run one frame.  Return True once the movie has ended."""
+        sim = self.sim
+        self.num_frames += 1
+        if not (sim.step(vkeys) or vkeys == VK_EOM):
+            return False
+        if sim.outcome == 'door':
+            self.doors += 1
+        elif sim.outcome == 'fell':
+            self.falls += 1
+        if vkeys == VK_EOM:
+            self.ended = True
+            return True
+        if sim.outcome == 'door':
+            self.level_num = (self.level_num + 1) % len(self.all_levels)
+        self.start_level(sim.last_vkeys)
+        return False
+
+    def snapshot(self):
+        """Pack the level number, counters and Simulation state into bytes."""
+        return (self.state_struct.pack(self.level_num, self.num_frames,
+                                       self.doors, self.falls)
+                + self.sim.snapshot())
+
+    def restore(self, data):
+        """Put back the result of snapshot()."""
+        sz = self.state_struct.size
+        level_num, self.num_frames, self.doors, self.falls = \
+                   self.state_struct.unpack(data[:sz])
+        if level_num != self.level_num:
+            self.level_num = level_num
+            self.start_level(~0)
+        self.sim.restore(data[sz:])
+        self.ended = False
+
+def skip_notices(frames, notices, last_vkeys=~0):
+    """Read movie frames the way wbb.coprscreen() does during playback.
+
+For each notice screen, read one frame to flush out held keys and
+then wait for a press of A.
+
+Return (number of frames read, last vkeys), or None if the movie
+ended first.
+
+"""
+    from player import VK_A, VK_START
+
+    nframes = 0
+    for i in range(notices * 2):
+        for vkeys in frames:
+            new_vkeys = vkeys & ~last_vkeys
+            last_vkeys = vkeys
+            if vkeys == VK_EOM:
+                return None
+            nframes += 1
+            if i % 2 == 0 or new_vkeys & (VK_A | VK_START):
+                break
+    return nframes, last_vkeys
+
+def run_movie(frames, all_levels, level_num=0, notices=0, observer=None):
+    """Play a movie with no display, the way wbb.main() would.
+
+frames -- iterable of vkeys, one per frame
+all_levels -- list of level data structures; entering a door goes
+to the next one and falling restarts the current one
+level_num -- index into all_levels of the level to start on
+notices -- number of notice screens that the movie must dismiss
+with A before the first level starts
+observer -- if not None, added to each Simulation's observers
+
+Return a dict with these keys:
+'frames' -- number of movie frames played
+'doors' -- number of doors entered
+'falls' -- number of times the player fell below the playfield
+'level_num' -- index of the level being played when the movie ended
+'ballpos' -- the player's final position
+'cells_hash' -- SHA-1 of the final pf.cells as hex
+
+"""
+    from itertools import chain, repeat
+    from hashlib import sha1
+
+    # Start from the same state as a freshly launched game
+    wbbmath.nmis = 0
+    del chipsfx.queued_fx[:]
+    frames = chain(frames, repeat(VK_EOM))
+    result = {'frames': 0, 'doors': 0, 'falls': 0, 'level_num': level_num,
+              'ballpos': None, 'cells_hash': None}
+    notice_frames = skip_notices(frames, notices)
+    if notice_frames is None:
+        return result
+    nframes, last_vkeys = notice_frames
+
+    player = MoviePlayer(all_levels, level_num, last_vkeys,
+                         [observer] if observer else [])
+    for vkeys in frames:
+        if player.step(vkeys):
+            break
+    sim = player.sim
+    # The end-of-movie frame isn't part of the movie
+    result['frames'] = nframes + player.num_frames - 1
+    result['doors'] = player.doors
+    result['falls'] = player.falls
+    result['level_num'] = player.level_num
+    result['ballpos'] = tuple(sim.p.ballpos)
+    result['cells_hash'] = sha1(sim.pf.getcellbytes()).hexdigest()
+    return result
+
+class TraceChecker(object):
+    """Observer that compares each frame's state_hash() to a trace.
+
+trace -- sequence of state_hash() values recorded one per frame of
+gameplay, not counting notice screens
+
+Pass the movie through count_frames() so that a desync can be
+reported by movie frame, and call result() after the movie ends.
+
+"""
+    def __init__(self, trace):
+        self.trace = iter(trace)
+        self.movie_frames = self.gameplay_frames = 0
+        self.desync = None
+
+    def count_frames(self, frames):
+        for vkeys in frames:
+            yield vkeys
+            self.movie_frames += 1
+
+    def __call__(self, sim):
+        if self.desync:
+            return
+        want = next(self.trace, None)
+        if want is None:
+            return  # the movie ran out of frames
+        got = sim.state_hash()
+        if want != got:
+            self.desync = (self.gameplay_frames, self.movie_frames, want, got)
+            return
+        self.gameplay_frames += 1
+
+    def result(self):
+        """Return None if every frame matched, or the first desync as
+find_desync() does.
+
+"""
+        if self.desync is None:
+            want = next(self.trace, None)
+            if want is not None:
+                self.desync = (self.gameplay_frames, self.movie_frames,
+                               want, None)
+        return self.desync
+
+def find_desync(frames, trace, all_levels, level_num=0, notices=0):
+    """Replay a movie against a trace of state_hash() values.
+
+trace -- sequence of state_hash() values recorded one per frame of
+gameplay, not counting notice screens
+
+Return None if every frame matches, or a tuple
+(gameplay frame number, movie frame number, recorded hash, replayed hash)
+for the first frame that doesn't.  A hash is None past the end of
+the trace or of the replay.
+
+"""
+    checker = TraceChecker(trace)
+    run_movie(checker.count_frames(frames), all_levels, level_num, notices,
+              checker)
+    return checker.result()
+
+class RewindBuffer(object):
+    """Fixed-size history of a Simulation's recent frames, for rewinding.
+
+Every keyframe_interval frames, it keeps a snapshot() of the whole
+game state.  Between keyframes, it keeps only each frame's vkeys,
+and going back to a frame restores the keyframe before it and runs
+the game rules forward from there.  So the playfield is copied only
+once per keyframe, not once per frame.
+
+"""
+    def __init__(self, sim, num_keyframes=20, keyframe_interval=30):
+        from collections import deque
+
+        self.sim = sim
+        self.keyframe_interval = keyframe_interval
+        # Each is [frame number, snapshot, vkeys of frames since]
+        self.keyframes = deque(maxlen=num_keyframes)
+
+    def record(self, vkeys):
+        """Remember this frame's vkeys.  Call before sim.step(vkeys)."""
+        sim = self.sim
+        kf = self.keyframes
+        if not kf or sim.num_frames - kf[-1][0] >= self.keyframe_interval:
+            kf.append([sim.num_frames, sim.snapshot(), []])
+        kf[-1][2].append(vkeys)
+
+    def oldest_frame(self):
+        return self.keyframes[0][0] if self.keyframes else self.sim.num_frames
+
+    def seek(self, frame):
+        """Go back to the state after frame frames and forget everything later.
+
+Observers are not called for the frames that are run again.
+
+"""
+        sim = self.sim
+        kf = self.keyframes
+        while len(kf) > 1 and kf[-1][0] > frame:
+            kf.pop()
+        if not kf or kf[-1][0] > frame:
+            return
+        start, data, inputs = kf[-1]
+        del inputs[frame - start:]
+        sim.restore(data)
+        observers, sim.observers = sim.observers, []
+        try:
+            for vkeys in inputs:
+                sim.step(vkeys)
+        finally:
+            sim.observers = observers
+
+    def rewind(self, nframes=1):
+        """Go back up to nframes frames.  Return how many frames were undone."""
+        old_frames = self.sim.num_frames
+        self.seek(max(self.oldest_frame(), old_frames - nframes))
+        return old_frames - self.sim.num_frames
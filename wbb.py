@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 assert str is not bytes
+import time
 import pygame as G
 import joycfg
 from player import VK_A, VK_START, VK_UP, VK_DOWN, VK_LEFT, VK_RIGHT
+from simulation import VK_EOM
+from mtplane import NES_LAYOUT, WIDE_LAYOUT
 import chipsfx
 
 # True to skip what's new and controls
@@ -18,11 +21,42 @@ gfx_scale = 2
 
 with_music = True
 
+# Size of the playfield, as a dict of MetatilePlane arguments.
+# WIDE_LAYOUT keeps 16 more columns loaded ahead of the camera.
+# A taller playfield makes a taller window, so change the size in
+# vidcap_pipe_cmd to match.
+playfield_layout = NES_LAYOUT
+
 # set to something other than None to play a recorded demo
 movie_filename = None
 movierec_filename = 'tasrec.txt'
 
+# True to continue the movie in movierec_filename left by a crash:
+# its frames are played back, and then recording continues from the
+# end of it.  No trace is saved for a resumed movie.
+movierec_resume = False
+
+# set to something other than None to record Simulation.state_hash()
+# for each frame of gameplay while recording a movie, such as
+# 'tasrec.trace' for use with movieverify.py
+movietrace_filename = None
+
+# Seconds of gameplay to keep for rewinding with Backspace, or 0 to
+# turn off rewinding.  Rewinding also takes the rewound frames out of
+# the movie being recorded.
+rewind_seconds = 10
+
+# True to play the demo as fast as the CPU allows, without drawing,
+# playing sound, or waiting for vsync, except on the movie frames
+# listed in fastforward_capture
+movie_fastforward = False
+fastforward_capture = frozenset()
+
 keybindings_filename = "wbb.kyb"
+
+# Directory in which to keep synthesized sound effects between runs,
+# or None to synthesize them at each start
+sfx_cache_dir = 'sfxcache'
 mixer_freq = 44100
 
 # ffmpeg or avconv command line through which to pipe
@@ -35,6 +69,12 @@ mixer_freq = 44100
 # the maintainer of Debian's "ffmpeg" package is a Libav developer.
 vidcap_pipe_cmd = r"""avconv -f rawvideo -r 30 -pix_fmt rgb24 -s "256x208" -y -an -i - -c:v png wbb.avi"""
 
+# Sound effects during video capture are written to this WAV file as
+# each frame is shown, so it lines up with the video from the first
+# frame.  Mux them with something like
+# avconv -i wbb.avi -i atee.wav -c:v copy -c:a flac wbb.mkv
+audiotee_filename = 'atee.wav'
+
 coprNotice = """
 Wrecking Ball Boy (WIP)
 Copr. 2013 Damian Yerrick
@@ -56,6 +96,7 @@ Press a key"""
 
 belowBindingsNotice = """
 Ctrl+R: reset; Esc: quit
+Backspace: rewind
 
 Press a key"""
 
@@ -96,25 +137,33 @@ action_names = [
     'A', # 'B', 'Select', 'Start'
 ]
 
-VK_EOM = 0x100
-
 last_vkeys = ~0
 moviedata = None
-tasrecdata = bytearray()
+movie_frame = -1  # index of the last frame read from moviedata
+tasrecorder = None
+tastracedata = []
 def read_pads():
-    global last_vkeys
+    global last_vkeys, movie_frame, moviedata
 
     # Most of the engine handles vkeys in NES order
+    vkeys = None
     if moviedata:
         try:
             vkeys = next(moviedata)
         except StopIteration:
-            vkeys = VK_EOM
-    else:
+            if tasrecorder:
+                # Done playing back a resumed movie; go live
+                moviedata = None
+            else:
+                vkeys = VK_EOM
+        else:
+            movie_frame += 1
+    if vkeys is None:
         newbindings = (bindings[4:] + [None, None, None][:8 - len(bindings)]
                        + bindings[:4])
         vkeys = joycfg.read_pad(newbindings)
-        tasrecdata.append(vkeys)
+        if tasrecorder:
+            tasrecorder.append(vkeys)
     new_vkeys = vkeys & ~last_vkeys
     last_vkeys = vkeys
     return (vkeys, new_vkeys)
@@ -128,44 +177,71 @@ def list_fields(p):
     pd = [(n, v) for (n, v) in pd if not isinstance(v, Callable)]
     print("\n".join(repr(row) for row in pd))
 
-def runonce(enl, font, level):
-    from mtplane import MetatilePlane
-    from player import Player, TumblingBlock
-    from levels import load_level, load_level_col
-    from wbbmath import inc_nmis
-    global helptxt
-
-    p = Player()
-    p.ropeparts_png = G.image.load('tilesets/ropeparts.png').convert_alpha()
-    swinging2_png = G.image.load('tilesets/swinging2.png').convert_alpha()
-    p.swinging_png = [swinging2_png,
-                      G.transform.flip(swinging2_png, True, False),
-                      G.transform.flip(swinging2_png, False, True),
-                      G.transform.flip(swinging2_png, True, True)]
-    del swinging2_png
-    pf = MetatilePlane()
-    pf.sheet = G.image.load('tilesets/bgtiles.png').convert()
-    TumblingBlock.sheet = G.image.load('tilesets/tumbling_box.png').convert()
-    load_level(pf, level)
-    startpos = level['start']
-    p.ballpos = [startpos[0] * 16 + 8, startpos[1] * 16 + 11]
-    p.pf = pf
-    screen = enl.get_surface()
-    pfdst = screen.subsurface((0, 16, 256, 192))
-    
+class PlayfieldView(object):
+    """Draw a Simulation to the screen as an observer."""
+
     status_bgc = (89, 167, 255)
+
+    def __init__(self, enl, font, sim):
+        from player import TumblingBlock
+
+        p = sim.p
+        p.ropeparts_png = G.image.load('tilesets/ropeparts.png').convert_alpha()
+        swinging2_png = G.image.load('tilesets/swinging2.png').convert_alpha()
+        p.swinging_png = [swinging2_png,
+                          G.transform.flip(swinging2_png, True, False),
+                          G.transform.flip(swinging2_png, False, True),
+                          G.transform.flip(swinging2_png, True, True)]
+        del swinging2_png
+        sim.pf.sheet = G.image.load('tilesets/bgtiles.png').convert()
+        TumblingBlock.sheet = G.image.load('tilesets/tumbling_box.png').convert()
+        self.font = font
+        self.screen = enl.get_surface()
+        self.pfdst = self.screen.subsurface((0, 16, 256, sim.pf.height * 16))
+        self.last_camx = 0
+        self.last_frame = -1
+
+    def __call__(self, sim):
+        pf, pfdst, camx = sim.pf, self.pfdst, sim.camx
+        # Redraw everything after scrolling or after skipped frames
+        if camx != self.last_camx or sim.num_frames != self.last_frame + 1:
+            pf.cleardirty(True)
+            self.last_camx = camx
+        self.last_frame = sim.num_frames
+        old_dirty = pf.redrawdirty(pfdst, camx, 0)
+        spr_rects = []
+        spr_rects.extend(sim.p.draw(pfdst, camx))
+        for t in pf.tumble:
+            spr_rects.extend(t.draw(pfdst, camx))
+        pf.setdirtyrects(spr_rects, camx)
+        new_dirty = pf.getdirtyruns()
+        all_dirty = pf.unionoldnewdirty(old_dirty, new_dirty)
+        to_update = pf.dirtyrunstorects(all_dirty)
+
+        screen = self.screen
+        screen.fill(self.status_bgc, (0, 0, 256, 16))
+        txtrct = self.font.textout(screen, sim.helptxt, 16, 8)
+
+def runonce(enl, font, level, is_first_level=False):
+    from simulation import Simulation, RewindBuffer
+    global last_vkeys
+
+    sim = Simulation(level, is_first_level, last_vkeys, playfield_layout)
+    view = PlayfieldView(enl, font, sim)
+    fastforward = moviedata and movie_fastforward and not tasrecorder
+    if not fastforward:
+        sim.observers.append(view)
+        sim.observers.append(lambda sim: chipsfx.fxq_play(sfxplayers))
+    if not moviedata and movietrace_filename:
+        sim.observers.append(lambda sim: tastracedata.append(sim.state_hash()))
+    if rewind_seconds and not moviedata:
+        rewinder = RewindBuffer(sim, rewind_seconds * 2, 30)
+    else:
+        rewinder = None
     clk = G.time.Clock()
     done = False
     retrying = False
 
-    pf.tumble = []
-    helptxt = ("\x1b\x1a\x19\x18:move  A:push  \x19A: pull"
-               if level == first_level
-               else "")
-
-    soln = None
-    last_camx = 0
-    pf.win_x = 0
     while not done:
         for event in G.event.get():
             if event.type == G.KEYDOWN:
@@ -176,68 +252,41 @@ def runonce(enl, font, level):
                     done = True
                     retrying = True
                 if (event.key == G.K_p and (event.mod & G.KMOD_CTRL)):
-                    G.image.save(pfdst, "wbb_snap.png")
+                    G.image.save(view.pfdst, "wbb_snap.png")
             if event.type == G.QUIT:
                 done = True
+        if rewinder and not done and G.key.get_pressed()[G.K_BACKSPACE]:
+            undone = rewinder.rewind()
+            if undone and tasrecorder:
+                tasrecorder.truncate(undone)
+                if movietrace_filename:
+                    del tastracedata[len(tastracedata) - undone:]
+            last_vkeys = sim.last_vkeys
+            view(sim)
+            clk.tick(60)
+            enl.flip()
+            continue
         (vkeys, new_vkeys) = read_pads()
-        if new_vkeys & VK_EOM:
-            done = True
-        p.move(vkeys, new_vkeys)
-        p.ballpos[0] = max(pf.win_x * 16 + 4, p.ballpos[0])
-        if p.state == p.ST_ENTERING_DOOR and p.walking_frame >= 1024:
+        if rewinder:
+            rewinder.record(vkeys)
+        capturing = fastforward and movie_frame in fastforward_capture
+        if capturing:
+            sim.observers.append(view)
+        if sim.step(vkeys, new_vkeys):
             done = True
-            retrying = 'd'
-        # if below pfdst and not hanging, fail
-        if (p.ballpos[1] >= 208 and (not p.rope or p.rope.vel)):
-            done = True
-            retrying = not with_vidcap
-
-        pf.tumble = [t for t in pf.tumble if t and not t.done()]
-        for t in pf.tumble:
-            t.move()
-
-        if not soln and p.ballpos[0] >= 192+512 and level == first_level:
-            if not pf.getcell(14+32, 9):
-                soln = '2. Nova'
-            elif pf.getcell(13+32, 10):
-                soln = '1. Pino'
-            elif p.state == p.ST_CLIMBING and p.ballpos[0] >= 216+512:
-                soln = "3. Snowy"
-            if soln:
-                helptxt = soln
-
-        # scrolling
-        camtarget = p.ballpos[0] + (-16 if p.facing_left else 16)
-        if p.rope and p.rope.pos and p.state == p.ST_FALLING:
-            camtarget = (camtarget + p.rope.pos[0]) / 2
-        camx = max(int(camtarget) - 128, pf.win_x * 16)
-        camdelta = abs(camx - last_camx) // 16 + 1
-        camx = min(last_camx + camdelta, max(last_camx - camdelta, camx))
-        if camx != last_camx:
-            wanted_winx = camx // 16
-            if wanted_winx >= pf.win_x + 15:
-                pf.win_x += 1
-                load_level_col(pf, level, pf.win_x + 31)
-            pf.cleardirty(True)
-            last_camx = camx
-        old_dirty = pf.redrawdirty(pfdst, camx, 0)
-        spr_rects = []
-        spr_rects.extend(p.draw(pfdst, camx))
-        for t in pf.tumble:
-            spr_rects.extend(t.draw(pfdst, camx))
-        pf.setdirtyrects(spr_rects, camx)
-        new_dirty = pf.getdirtyruns()
-        all_dirty = pf.unionoldnewdirty(old_dirty, new_dirty)
-        to_update = pf.dirtyrunstorects(all_dirty)
-        chipsfx.fxq_play(sfx, enl.num_frames)
-
-        screen.fill(status_bgc, (0, 0, 256, 16))
-        txtrct = font.textout(screen, helptxt, 16, 8)
+            if sim.outcome == 'door':
+                retrying = 'd'
+            elif sim.outcome == 'fell':
+                retrying = not with_vidcap
+        if fastforward:
+            if capturing:
+                sim.observers.remove(view)
+                enl.flip()
+            continue
         if moviedata and (G.key.get_mods() & G.KMOD_RCTRL):
             clk.tick(600)
         else:
             clk.tick(60)
-        inc_nmis()
         enl.flip()
     return retrying
 
@@ -268,7 +317,8 @@ the form to close, or None if the form was closed by pressing A.
         if new_vkeys & (VK_A | VK_START):
             done = True
 
-        clk.tick(30)
+        if not (moviedata and movie_fastforward and not tasrecorder):
+            clk.tick(30)
     return r
 
 def irle(it):
@@ -280,34 +330,184 @@ def irle(it):
                 yield (last, lastamt)
             last, lastamt = i, 0
         lastamt += 1
-    yield (last, lastamt)
+    if lastamt:
+        yield (last, lastamt)
+
+tas_save_btns = [(0x80 >> i, b) for (i, b) in enumerate('AB__UDLR')]
+tas_load_btns = {'U': VK_UP, 'D': VK_DOWN, 'L': VK_LEFT, 'R': VK_RIGHT, 'A': VK_A}
+
+def format_tas_run(vkeys, n):
+    """Format n frames of holding vkeys as a line of a movie."""
+    btns = ''.join(b if (vkeys & i) else '' for (i, b) in tas_save_btns)
+    return (btns or '-') + (" %d\n" % n if n > 1 else "\n")
+
+def parse_tas_line(line):
+    """Parse a line of a movie.
+
+Return a tuple (vkeys, number of frames), or None for a blank or
+comment line.
+
+"""
+    line = line.split('#', 1)[0].split()[:2]
+    if not line:
+        return None
+    nframes = int(line[1]) if len(line) > 1 and line[1].isdigit() else 1
+    btns = 0
+    for c in line[0].upper():
+        btns |= tas_load_btns.get(c, 0)
+    return (btns, nframes)
 
 def save_tas(frames, filename):
-    btns = 'AB__UDLR'
-    btns = [(0x80 >> i, b) for (i, b) in enumerate(btns)]
-    frames = [(''.join(b if (vkeys & i) else '' for (i, b) in btns) or '-',
-               " %d\n" % n if n > 1 else "\n")
-              for (vkeys, n) in irle(frames)]
+    """Write vkeys to a movie file one run of identical frames at a time."""
     with open(filename, 'wt') as outfp:
-        outfp.writelines(c for row in frames for c in row)
+        for (vkeys, n) in irle(frames):
+            outfp.write(format_tas_run(vkeys, n))
+
+class TasRecorder(object):
+    """Record a movie to a file while it is being played.
+
+Runs of identical frames are written by a background thread, so a
+crash loses at most the last few seconds and a long session doesn't
+keep the whole movie in memory.  The most recent holdback frames
+stay in memory so that rewinding can take them back out with
+truncate().  Runs are written in batches of at least batch frames,
+so a long hold is split into a few long lines rather than many
+short ones.
+
+filename -- movie file to write
+resume -- if True and filename exists, keep its frames and append
+to it, dropping a line left partly written by a crash; the number of
+frames kept is in resumed_frames
+holdback -- frames to keep in memory for truncate()
+batch -- frames past holdback to collect before writing them
+max_queued -- runs the writer thread may fall behind before
+append() waits for it
+
+"""
+    def __init__(self, filename, resume=False, holdback=660, batch=300,
+                 max_queued=256):
+        import threading
+        from queue import Queue
+
+        self.holdback, self.batch = holdback, batch
+        self.runs = []  # [vkeys, n] not yet handed to the writer
+        self.num_held = 0  # total frames in self.runs
+        self.resumed_frames = 0
+        if resume:
+            self.outfp = self.open_resumed(filename)
+        else:
+            self.outfp = open(filename, 'wt')
+        self.queue = Queue(max_queued)
+        self.writer = threading.Thread(target=self.write_runs)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def open_resumed(self, filename):
+        try:
+            infp = open(filename, 'rb')
+        except IOError:
+            return open(filename, 'wt')
+        with infp:
+            data = infp.read()
+        # A crash can leave the last line partly written, with a
+        # frame count missing digits, so keep only complete lines
+        data = data[:data.rfind(b'\n') + 1]
+        with open(filename, 'r+b') as outfp:
+            outfp.truncate(len(data))
+        self.resumed_frames = sum(
+            run[1] for run in read_tas_runs(data.decode('ascii', 'replace')
+                                            .splitlines(True))
+        )
+        return open(filename, 'at')
+
+    def write_runs(self):
+        while True:
+            line = self.queue.get()
+            if line is None:
+                break
+            self.outfp.write(line)
+            if self.queue.empty():
+                self.outfp.flush()
+
+    def append(self, vkeys):
+        """Add one frame to the end of the movie."""
+        if self.runs and self.runs[-1][0] == vkeys:
+            self.runs[-1][1] += 1
+        else:
+            self.runs.append([vkeys, 1])
+        self.num_held += 1
+        if self.num_held >= self.holdback + self.batch:
+            self.write_held(self.num_held - self.holdback)
+
+    def write_held(self, nframes):
+        """Hand the oldest nframes held frames to the writer thread."""
+        while nframes > 0:
+            run = self.runs[0]
+            n = min(run[1], nframes)
+            self.queue.put(format_tas_run(run[0], n))
+            run[1] -= n
+            if not run[1]:
+                del self.runs[0]
+            self.num_held -= n
+            nframes -= n
+
+    def truncate(self, nframes):
+        """Remove up to nframes frames from the end of the movie.
+
+Only frames not yet written can be removed.  Return the number of
+frames removed.
+
+"""
+        nframes = removed = min(nframes, self.num_held)
+        while nframes > 0:
+            run = self.runs[-1]
+            n = min(run[1], nframes)
+            run[1] -= n
+            if not run[1]:
+                del self.runs[-1]
+            nframes -= n
+        self.num_held -= removed
+        return removed
+
+    def close(self):
+        """Write all held frames and close the file."""
+        self.write_held(self.num_held)
+        self.queue.put(None)
+        self.writer.join()
+        self.outfp.close()
+
+def save_trace(trace, filename):
+    """Write state hashes as 32-bit little-endian words."""
+    from struct import pack
+    with open(filename, 'wb') as outfp:
+        outfp.write(pack('<%dI' % len(trace), *trace))
+
+def load_trace(filename):
+    from struct import unpack
+    with open(filename, 'rb') as infp:
+        data = infp.read()
+    return list(unpack('<%dI' % (len(data) // 4), data[:len(data) // 4 * 4]))
+
+def read_tas_runs(infp):
+    """Iterate over (vkeys, number of frames) for each line of a movie file."""
+    for line in infp:
+        run = parse_tas_line(line)
+        if run:
+            yield run
 
 def load_tas(filename):
-    from operator import or_
-    try:
-        reduce
-    except NameError:
-        from functools import reduce
-
-    out = bytearray()
-    tasbindings = {'U': VK_UP, 'D': VK_DOWN, 'L': VK_LEFT, 'R': VK_RIGHT, 'A': VK_A}
-    with open(movie_filename, 'r') as infp:
-        lines = [_f for _f in (line.strip().split('#', 1)[0] for line in infp) if _f]
-    for line in lines:
-        line = [c.strip() for c in line.split()[:2]]
-        nframes = int(line[1]) if len(line) > 1 and line[1].isdigit() else 1
-        btns = reduce(or_, (tasbindings.get(c, 0) for c in line[0].upper()))
-        out.extend([btns] * nframes)
-    return out
+    """Iterate over the vkeys of each frame of a movie file.
+
+Frames are read from the file as they are needed, so a long hold
+costs no more memory than a short one.
+
+"""
+    from itertools import repeat
+
+    with open(filename, 'r') as infp:
+        for (btns, nframes) in read_tas_runs(infp):
+            for vkeys in repeat(btns, nframes):
+                yield vkeys
 
 sfxdata = [
     ('launch', 0, 1, bytearray([
@@ -343,21 +543,17 @@ level_filenames = [
     'levels/first.map', 'levels/hubs.map'
 ]
 
+# set to something other than None to play the levels in a level
+# pack made with packlevels.py instead of level_filenames
+level_pack_filename = None
+
 def main():
     from enlarger import Enlarger
-    from levels import load_all_levels
+    from levels import load_all_levels, LevelPack
     from ascii import PyGtxt
-    global bindings, sfx, moviedata
+    global bindings, sfxplayers, moviedata, tasrecorder
 
-    sfx = chipsfx.make_sound_effects(sfxdata)
-    try:
-        sfx = dict((name, G.mixer.Sound(samples))
-                   for (name, samples) in sfx.items())
-    except TypeError as e:
-        # did this change between 2.6 and 2.7, or between Linux and
-        # Mac, or between 1.9.1 and 1.9.2?
-        sfx = dict((name, G.mixer.Sound(buffer=samples))
-                   for (name, samples) in sfx.items())
+    sfx = chipsfx.make_sound_effects(sfxdata, sfx_cache_dir)
     joycfg.dump_joysticks(verbose=False)
     wndicon = G.image.load('tilesets/wndicon.png')
     if with_music:
@@ -367,13 +563,22 @@ def main():
     font = PyGtxt(G.image.load('tilesets/ascii.png'), 8, 8)
 
     # set display mode
-    logisize = (256, 208)
+    logisize = (256, 16 + playfield_layout['height'] * 16)
     physsize = tuple(c * gfx_scale for c in logisize)
     screen = G.display.set_mode(physsize)
     enl = Enlarger(screen, logisize if gfx_scale > 1 else None, True)
 
     if movie_filename:
-        moviedata = iter(load_tas(movie_filename))
+        moviedata = load_tas(movie_filename)
+    elif movierec_filename:
+        from itertools import islice
+
+        # Hold back enough frames for the longest possible rewind
+        tasrecorder = TasRecorder(movierec_filename, movierec_resume,
+                                  (rewind_seconds * 2 + 2) * 30)
+        if tasrecorder.resumed_frames:
+            moviedata = islice(load_tas(movierec_filename),
+                               tasrecorder.resumed_frames)
 
 ##    fontimg = G.image.load('tilesets/vwf7.png')
 ##    fontimg.set_colorkey(0)
@@ -432,6 +637,14 @@ def main():
             # avconv -f rawvideo -r 30 -pix_fmt rgb24 -s 256x192 -y -an -i vtee.raw -c:v png vtee.avi
             # or see http://www.iabaldwin.com/2011/02/piping-raw-data-info-ffmpeg/
         enl.set_videotee(video_outfp, 2)
+        import wave
+        audio_outfp = wave.open(audiotee_filename, 'wb')
+        audio_outfp.setnchannels(1)
+        audio_outfp.setsampwidth(2)
+        audio_outfp.setframerate(chipsfx.mixer_freq)
+        fxcapture = chipsfx.ApuMixer(sfx, sfxdata)
+        enl.set_audiotee(audio_outfp, fxcapture.render,
+                         chipsfx.mixer_freq // 60)
         title_png = G.image.load('tilesets/title.png')
         enl.get_surface().blit(title_png, (0, 0))
         for i in range(120):
@@ -439,31 +652,57 @@ def main():
     else:
         video_outfp = None
 
-    all_levels = load_all_levels(level_filenames)
-    global first_level
-    first_level = all_levels[0]
+    if level_pack_filename:
+        all_levels = LevelPack(level_pack_filename)
+    else:
+        all_levels = load_all_levels(level_filenames)
 
     level_num = 0
+    start_time = time.time()
+    sfxplayer = chipsfx.ApuPlayer(chipsfx.ApuMixer(sfx, sfxdata))
+    sfxplayers = [sfxplayer, fxcapture] if video_outfp else [sfxplayer]
     try:
         if with_music:
             G.mixer.music.set_volume(.7)
             G.mixer.music.play(-1)
         while True:
-            continuing = runonce(enl, font, all_levels[level_num])
+            continuing = runonce(enl, font, all_levels[level_num],
+                                 level_num == 0)
             if not continuing:
                 break
             if continuing == 'd':
                 level_num = (level_num + 1) % len(all_levels)
+        if movie_filename and movie_fastforward:
+            elapsed = max(time.time() - start_time, 1e-6)
+            print("Replayed %d frames in %.2f s (%.0f frames/s)"
+                  % (movie_frame + 1, elapsed, (movie_frame + 1) / elapsed))
     finally:
         G.mixer.music.stop()
-        if tasrecdata and movierec_filename:
-            save_tas(tasrecdata, movierec_filename)
+        sfxplayer.close()
+        if level_pack_filename:
+            all_levels.close()
+        if tasrecorder:
+            tasrecorder.close()
+            if (tastracedata and movietrace_filename
+                and not tasrecorder.resumed_frames):
+                save_trace(tastracedata, movietrace_filename)
         if video_outfp:
             enl.get_surface().blit(title_png, (0, 0))
+            # End on a whole video frame so that the audio, written
+            # at every flip, is exactly as long as the video.
+            # videotee_left is nonzero after a flip that started a
+            # video frame but before the flips it spans are done.
             for i in range(60):
                 enl.flip()
+            while enl.videotee_left > 0:
+                enl.flip()
             video_outfp.close()  # send EOF to avconv to make it finish encoding
-            chipsfx.render_logged_fx(sfxdata, enl.num_frames)
+            audio_outfp.close()
+            if not enl.tee_lengths_match():
+                import sys
+                print("wbb.py: captured %d audio samples for %d video frames"
+                      % (enl.audiotee_samples, enl.videotee_frames),
+                      file=sys.stderr)
             if ffpipe:
                 ffpipe.wait()
         else:
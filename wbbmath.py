@@ -33,6 +33,19 @@ def plus_gravity(dy):
     gravity = 17 + (nmis & 1)
     return dy + gravity / 256.0
 
+def float_mask(values):
+    """Get a bitmask of which values are floats.
+
+Savestates pack numbers as doubles.  Restoring with unmask_floats()
+gives back ints where there were ints, as some code shifts them or
+uses them as indices.
+
+"""
+    return sum(1 << i for (i, v) in enumerate(values) if isinstance(v, float))
+
+def unmask_floats(mask, values):
+    return [v if mask & (1 << i) else int(v) for (i, v) in enumerate(values)]
+
 def clip_vel_to_cable(balldisp, ballvel, cablelen):
     """Clip the distance and velocity of a tethered object.
 